@@ -35,6 +35,12 @@ setup(
                  'vxportia'},
     include_package_data=True,
     install_requires=requirements,
+    entry_points={
+        'console_scripts': [
+            'vxportia-preload = vxportia.preload:main',
+            'vxportia-replay = vxportia.replay:main',
+        ],
+    },
     license="BSD",
     zip_safe=False,
     keywords='vxportia',
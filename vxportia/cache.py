@@ -0,0 +1,133 @@
+from collections import OrderedDict
+from urlparse import urlparse
+
+import txredisapi
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.python import log
+
+
+def redis_from_uri(redis_uri):
+    url = urlparse(redis_uri)
+    return txredisapi.lazyConnection(
+        url.hostname, int(url.port or 6379), dbid=int(url.path[1:] or 0))
+
+
+class ResolveCache(object):
+
+    clock = reactor
+
+    def __init__(self, size=0, ttl=0):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, msisdn, stale=False):
+        # Expired entries are kept around until evicted so that they can
+        # still be used when Portia itself isn't available.
+        entry = self.entries.get(msisdn)
+        if entry is None:
+            return None
+        network, expires = entry
+        if stale or self.clock.seconds() < expires:
+            return network
+        return None
+
+    def invalidate_networks(self, networks):
+        for msisdn, (network, _) in self.entries.items():
+            if network in networks:
+                del self.entries[msisdn]
+
+    def set(self, msisdn, network):
+        if not self.size:
+            return
+        self.entries.pop(msisdn, None)
+        self.entries[msisdn] = (network, self.clock.seconds() + self.ttl)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class RedisResolveCache(object):
+
+    clock = reactor
+    # Lookups waiting for the next MGET beyond this are treated as misses.
+    max_batch_size = 1000
+
+    def __init__(self, redis, prefix='vxportia:resolve:', ttls=None,
+                 default_ttl=300, timeout=0.1):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.timeout = timeout
+        self.batch = {}
+        self.fetching = False
+        # Writes aren't waited for, this is kept so that they can be.
+        self.last_set = None
+
+    def key(self, msisdn):
+        return '%s%s' % (self.prefix, msisdn)
+
+    def get(self, msisdn):
+        # Only one MGET is in flight at a time, lookups made meanwhile are
+        # batched into the next one.
+        if len(self.batch) >= self.max_batch_size:
+            return succeed(None)
+        d = Deferred()
+        d.addBoth(self.cancel_timeout, self.clock.callLater(
+            self.timeout, self.force_timeout, d))
+        self.batch.setdefault(msisdn, []).append(d)
+        if not self.fetching:
+            self.fetch()
+        return d
+
+    def force_timeout(self, d):
+        if not d.called:
+            d.callback(None)
+
+    def cancel_timeout(self, result, delayed_call):
+        if delayed_call.active():
+            delayed_call.cancel()
+        return result
+
+    def get_many(self, msisdns):
+        d = maybeDeferred(
+            self.redis.mget, [self.key(msisdn) for msisdn in msisdns])
+        d.addCallback(lambda networks: dict(zip(msisdns, networks)))
+        return d
+
+    def fetch(self):
+        batch, self.batch = self.batch, {}
+        self.fetching = True
+
+        def deliver(networks):
+            for msisdn, waiters in batch.items():
+                for d in waiters:
+                    if not d.called:
+                        d.callback(networks.get(msisdn))
+
+        def failed(failure):
+            log.err(failure, 'Unable to read resolves from Redis.')
+            return {}
+
+        def done(_):
+            self.fetching = False
+            if self.batch:
+                self.fetch()
+
+        d = self.get_many(batch.keys())
+        d.addErrback(failed)
+        d.addCallback(deliver)
+        d.addBoth(done)
+
+    def set(self, msisdn, network, strategy=None):
+        d = maybeDeferred(
+            self.redis.setex, self.key(msisdn),
+            self.ttls.get(strategy, self.default_ttl), network)
+        d.addErrback(log.err, 'Unable to cache resolve in Redis.')
+        self.last_set = d
+        return d
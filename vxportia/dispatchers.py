@@ -1,13 +1,30 @@
-from twisted.internet.defer import inlineCallbacks, returnValue
+import signal
+from collections import deque
+
+import yaml
+
+from twisted.internet.defer import (
+    CancelledError, Deferred, fail, gatherResults, inlineCallbacks,
+    returnValue, succeed)
 from twisted.internet.protocol import Factory
 from twisted.internet import reactor
+from twisted.web.server import Site
 
-from vumi.config import ConfigDict, ConfigClientEndpoint
+from vumi import log
+from vumi.config import (
+    ConfigBool, ConfigDict, ConfigClientEndpoint, ConfigFloat, ConfigInt,
+    ConfigServerEndpoint, ConfigText)
 from vumi.dispatchers.endpoint_dispatchers import Dispatcher
 from vumi.errors import DispatcherError
 from vumi.utils import normalize_msisdn
 
+from vxportia.cache import RedisResolveCache, ResolveCache, redis_from_uri
+from vxportia.health import HealthResource
+from vxportia.profiling import DispatcherProfiler, timed_handler
 from vxportia.protocol import PortiaProtocol
+from vxportia.recording import TrafficRecorder, open_recording
+from vxportia.routing import RoutingTable
+from vxportia.throttle import MNOThrottle
 
 
 def portia_normalize_msisdn(msisdn):
@@ -15,6 +32,21 @@ def portia_normalize_msisdn(msisdn):
     return normalize_msisdn(msisdn)[1:]
 
 
+def validate_mno_limits(mno_limits, routing):
+    for mno, limits in mno_limits.items():
+        if mno not in routing.mno_names:
+            raise DispatcherError(
+                'Limits configured for unknown MNO: %s.' % (mno,))
+        for name, value in limits.items():
+            if name not in ('rate', 'burst', 'concurrency', 'buffer_size'):
+                raise DispatcherError(
+                    'Unknown limit for %s: %s.' % (mno, name))
+            if not isinstance(value, (int, float)) or value <= 0:
+                raise DispatcherError(
+                    'Limit %s for %s must be a positive number.' % (
+                        name, mno))
+
+
 class PortiaDispatcherConfig(Dispatcher.CONFIG_CLASS):
     portia_endpoint = ConfigClientEndpoint(
         'The Twisted Endpoint to use when connecting to the Portia server.',
@@ -23,21 +55,115 @@ class PortiaDispatcherConfig(Dispatcher.CONFIG_CLASS):
         "How transport names map endpoints and to MNOs. Format is: "
         "transport_name -> endpoint -> MNO name.",
         required=True, static=True)
+    mno_limits = ConfigDict(
+        "Outbound limits per MNO name. Each MNO maps to a dict with any of "
+        "'rate' (messages per second), 'burst', 'concurrency' and "
+        "'buffer_size' (default 100). Outbound messages for a limited MNO "
+        "are buffered in memory until they can be sent, a full buffer "
+        "holds up further messages for that MNO. Buffered messages are "
+        "already acknowledged, so up to 'buffer_size' messages per MNO are "
+        "lost if the dispatcher is killed.",
+        default={}, static=True)
+    portia_max_in_flight = ConfigInt(
+        "The maximum number of commands awaiting a reply from Portia. "
+        "Commands beyond this are queued and resolves are sent ahead of "
+        "annotates. Unlimited if not set.",
+        default=None, static=True)
+    portia_max_queued = ConfigInt(
+        "The maximum number of commands of each priority waiting to be "
+        "sent to Portia when `portia_max_in_flight` is reached. Further "
+        "commands of that priority fail immediately, queued annotates "
+        "never hold up resolves. Unlimited if not set.",
+        default=None, static=True)
+    portia_starvation_limit = ConfigInt(
+        "How many times a queued annotate can be passed over for resolves "
+        "before it is sent regardless.",
+        default=PortiaProtocol.starvation_limit, static=True)
+    portia_buffer_size = ConfigInt(
+        "How many outbound messages may wait for the connection to Portia "
+        "to be established before further messages are rejected. Also how "
+        "many annotates for inbound messages are kept to send once it is, "
+        "the oldest are dropped beyond this.",
+        default=1000, static=True)
+    prefix_fallback = ConfigDict(
+        "MSISDN prefix -> MNO name, used to route outbound messages while "
+        "Portia is not connected. The longest matching prefix wins.",
+        default={}, static=True)
+    resolve_cache_size = ConfigInt(
+        "How many resolved MSISDNs to keep in memory. Disabled if 0.",
+        default=0, static=True)
+    resolve_cache_ttl = ConfigInt(
+        "How many seconds a cached resolve is used for. Expired entries are "
+        "still used while Portia is not connected.",
+        default=300, static=True)
+    portia_record_path = ConfigText(
+        "File to record Portia requests and replies to for replaying "
+        "later, compressed if it ends in .gz. Disabled if not set.",
+        static=True)
+    portia_record_sample_rate = ConfigFloat(
+        "The fraction of Portia requests to record.",
+        default=1.0, static=True)
+    redis_cache_uri = ConfigText(
+        "The redis://hostname:port/db of a Redis shared between dispatchers "
+        "to cache resolved networks in. Disabled if not set.",
+        static=True)
+    redis_cache_prefix = ConfigText(
+        "The Redis keyspace prefix to use for cached resolves.",
+        default='vxportia:resolve:', static=True)
+    redis_cache_ttls = ConfigDict(
+        "Seconds to keep a resolve in Redis for, keyed by the Portia "
+        "strategy that produced it.",
+        default={
+            'ported-to': 86400,
+            'observed-network': 3600,
+            'prefix-guess': 300,
+        }, static=True)
+    redis_cache_timeout = ConfigFloat(
+        "Seconds to wait for Redis before asking Portia instead.",
+        default=0.1, static=True)
+    health_endpoint = ConfigServerEndpoint(
+        "The Twisted Endpoint to serve /health and /ready on.",
+        static=True)
+    profiling = ConfigBool(
+        "Whether to record reactor lag and per-handler timings and to allow "
+        "sampling profiler dumps.",
+        default=False, static=True)
+    profiling_report_interval = ConfigFloat(
+        "How often, in seconds, to log reactor lag and handler timings.",
+        default=60.0, static=True)
+    profiling_lag_interval = ConfigFloat(
+        "How often, in seconds, to probe the reactor for lag.",
+        default=1.0, static=True)
+    profiling_signal = ConfigText(
+        "The signal that triggers a sampling profiler run.",
+        default='SIGUSR2', static=True)
+    profiling_sample_on_start = ConfigBool(
+        "Whether to start a sampling profiler run when the dispatcher "
+        "starts.",
+        default=False, static=True)
+    profiling_sample_interval = ConfigFloat(
+        "Seconds of CPU time between profiler samples.",
+        default=0.01, static=True)
+    profiling_sample_duration = ConfigFloat(
+        "How long, in seconds, a sampling profiler run lasts.",
+        default=30.0, static=True)
+    profiling_dump_path = ConfigText(
+        "Where to write sampling profiler dumps, may contain %(pid)s and "
+        "%(timestamp)d.",
+        default='vxportia-profile-%(pid)s-%(timestamp)d.txt', static=True)
 
-    def post_validate(self):
-        declared_mnos = []
-        mapped_transports = []
-        for transport, endpoints in self.mapping.items():
-            for endpoint, mno in endpoints.items():
-                declared_mnos.append(mno)
-                mapped_transports.append(transport)
-
-        if len(set(declared_mnos)) != len(declared_mnos):
-            raise DispatcherError('PortiaDispatcher mappings are not unique.')
+    mapping_reload_path = ConfigText(
+        "A YAML file to reload `mapping`, `receive_inbound_connectors` and "
+        "`mno_limits` from when `mapping_reload_signal` is received, "
+        "usually this worker's own config file.",
+        static=True)
+    mapping_reload_signal = ConfigText(
+        "The signal that triggers reloading the mapping.",
+        default='SIGHUP', static=True)
 
-        if set(mapped_transports) != set(self.receive_inbound_connectors):
-            raise DispatcherError(
-                'Not all receive_inbound_connectors mapped to MNOs.')
+    def post_validate(self):
+        routing = RoutingTable.compile(
+            self.mapping, self.receive_inbound_connectors)
 
         if len(self.receive_outbound_connectors) != 1:
             raise DispatcherError(
@@ -45,66 +171,379 @@ class PortiaDispatcherConfig(Dispatcher.CONFIG_CLASS):
                  'connector, there are %s configured.') % (
                     len(self.receive_outbound_connectors,)))
 
+        validate_mno_limits(self.mno_limits, routing)
+
 
 class PortiaDispatcher(Dispatcher):
 
     CONFIG_CLASS = PortiaDispatcherConfig
     clock = reactor
+    profiler = None
+    portia = None
+    redis_cache = None
+    recorder = None
+    health_listener = None
+    initial_reconnect_delay = 1
+    max_reconnect_delay = 30
 
     @inlineCallbacks
     def setup_dispatcher(self):
         config = self.get_static_config()
 
-        self.reverse_mno_map = {}
-        for transport, endpoints in config.mapping.items():
-            for endpoint, mno in endpoints.items():
-                self.reverse_mno_map[mno] = [transport, endpoint]
+        self.routing = RoutingTable.compile(
+            config.mapping, config.receive_inbound_connectors)
+        self.previous_signal_handler = None
+        if config.mapping_reload_path and config.mapping_reload_signal:
+            self.signum = getattr(signal, config.mapping_reload_signal)
+            self.previous_signal_handler = signal.signal(
+                self.signum, self.handle_reload_signal)
+
+        self.mno_limits = {}
+        self.throttles = {}
+        self.update_throttles(config.mno_limits)
+
+        self.fallback_prefixes = sorted(
+            config.prefix_fallback.items(),
+            key=lambda item: len(item[0]), reverse=True)
+        self.resolve_cache = ResolveCache(
+            config.resolve_cache_size, config.resolve_cache_ttl)
+        self.resolve_cache.clock = self.clock
+        if config.redis_cache_uri:
+            self.redis_cache = RedisResolveCache(
+                redis_from_uri(config.redis_cache_uri),
+                prefix=config.redis_cache_prefix,
+                ttls=config.redis_cache_ttls,
+                timeout=config.redis_cache_timeout)
+            self.redis_cache.clock = self.clock
 
         self.ro_connector = config.receive_outbound_connectors[0]
-        self.portia = yield config.portia_endpoint.connect(
+
+        if config.portia_record_path:
+            self.recorder = TrafficRecorder(
+                open_recording(config.portia_record_path, 'a'),
+                sample_rate=config.portia_record_sample_rate)
+            self.recorder.clock = self.clock
+
+        # NOTE: We don't wait for Portia here, messages arriving before
+        #       the connection is up are buffered or served locally.
+        self.portia_waiters = []
+        self.annotate_backlog = deque(maxlen=config.portia_buffer_size)
+        self.reconnect_delay = self.initial_reconnect_delay
+        self.reconnect_call = None
+        self.connect_portia()
+
+        if config.health_endpoint is not None:
+            self.health_listener = yield config.health_endpoint.listen(
+                Site(HealthResource(self)))
+
+        if config.profiling:
+            self.setup_profiler(config)
+
+    def update_throttles(self, mno_limits):
+        # Returns the throttles that are no longer needed, these still
+        # need to be flushed.
+        removed = []
+        for mno in set(self.mno_limits) - set(mno_limits):
+            removed.append(self.throttles.pop(mno))
+        for mno, limits in mno_limits.items():
+            if mno not in self.throttles:
+                throttle = MNOThrottle(**limits)
+                throttle.clock = self.clock
+                self.throttles[mno] = throttle
+            elif limits != self.mno_limits[mno]:
+                self.throttles[mno].reconfigure(**limits)
+        self.mno_limits = dict(mno_limits)
+        return removed
+
+    def connect_portia(self):
+        config = self.get_static_config()
+        self.reconnect_call = None
+        self.connect_d = config.portia_endpoint.connect(
             Factory.forProtocol(PortiaProtocol))
-        self.portia.clock = self.clock
+        self.connect_d.addCallbacks(
+            self.portia_connected, self.portia_connect_failed)
+
+    def portia_connected(self, portia):
+        config = self.get_static_config()
+        portia.clock = self.clock
+        portia.max_in_flight = config.portia_max_in_flight
+        portia.max_queued = config.portia_max_queued
+        portia.starvation_limit = config.portia_starvation_limit
+        portia.recorder = self.recorder
+        portia.disconnected_callback = self.portia_disconnected
+        self.portia = portia
+        self.reconnect_delay = self.initial_reconnect_delay
+        log.info('Connected to Portia.')
+
+        waiters, self.portia_waiters = self.portia_waiters, []
+        for d in waiters:
+            d.callback(portia)
+        self.send_annotate_backlog(portia)
+
+    def send_annotate_backlog(self, portia):
+        backlog = list(self.annotate_backlog)
+        self.annotate_backlog.clear()
+        return gatherResults([
+            self.send_annotate(portia, msisdn, mno)
+            for msisdn, mno in backlog])
+
+    def portia_connect_failed(self, failure):
+        if failure.check(CancelledError):
+            return
+        log.warning('Unable to connect to Portia, retrying in %ss: %s' % (
+            self.reconnect_delay, failure.getErrorMessage()))
+        self.schedule_reconnect()
+
+    def portia_disconnected(self, portia, reason):
+        if portia is not self.portia:
+            return
+        self.portia = None
+        log.warning('Lost connection to Portia, reconnecting in %ss: %s' % (
+            self.reconnect_delay, reason.getErrorMessage()))
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        self.reconnect_call = self.clock.callLater(
+            self.reconnect_delay, self.connect_portia)
+        self.reconnect_delay = min(
+            self.reconnect_delay * 2, self.max_reconnect_delay)
+
+    def portia_buffer_full(self):
+        config = self.get_static_config()
+        return len(self.portia_waiters) >= config.portia_buffer_size
+
+    def get_portia(self):
+        if self.portia is not None:
+            return succeed(self.portia)
+        if self.portia_buffer_full():
+            return fail(DispatcherError(
+                'Not connected to Portia and %s messages already waiting.' % (
+                    len(self.portia_waiters),)))
+        d = Deferred()
+        self.portia_waiters.append(d)
+        return d
+
+    def is_ready(self):
+        return self.portia is not None
+
+    def health(self):
+        return {
+            'ready': self.is_ready(),
+            'waiting': len(self.portia_waiters),
+            'annotates_waiting': len(self.annotate_backlog),
+            'cached': len(self.resolve_cache),
+            'buffered': dict(
+                (mno, len(throttle))
+                for mno, throttle in self.throttles.items()),
+        }
+
+    def setup_profiler(self, config):
+        self.profiler = DispatcherProfiler(
+            lag_interval=config.profiling_lag_interval,
+            report_interval=config.profiling_report_interval,
+            sample_interval=config.profiling_sample_interval,
+            sample_duration=config.profiling_sample_duration,
+            dump_path=config.profiling_dump_path)
+        self.profiler.clock = self.clock
+        self.profiler.start()
+        if config.profiling_signal:
+            self.profiler.install_signal_handler(config.profiling_signal)
+        if config.profiling_sample_on_start:
+            self.profiler.start_sampling()
 
+    def handle_reload_signal(self, signum, frame):
+        reactor.callFromThread(self.reload_from_file)
+
+    def reload_from_file(self):
+        config = self.get_static_config()
+        try:
+            with open(config.mapping_reload_path) as fp:
+                data = yaml.safe_load(fp) or {}
+        except (IOError, yaml.YAMLError):
+            log.error(None, 'Unable to read mapping from %s.' % (
+                config.mapping_reload_path,))
+            return succeed(None)
+        if not isinstance(data, dict):
+            log.error(None, 'Unable to read mapping from %s, expected a '
+                            'YAML mapping.' % (config.mapping_reload_path,))
+            return succeed(None)
+
+        d = self.reload_routing(
+            data.get('mapping', {}),
+            data.get('receive_inbound_connectors',
+                     config.receive_inbound_connectors),
+            data.get('mno_limits', {}))
+        d.addErrback(log.error, 'Unable to reload mapping from %s.' % (
+            config.mapping_reload_path,))
+        return d
+
+    @inlineCallbacks
+    def reload_routing(self, mapping, receive_inbound_connectors,
+                       mno_limits=None):
+        routing = RoutingTable.compile(mapping, receive_inbound_connectors)
+        if mno_limits is None:
+            mno_limits = self.mno_limits
+        validate_mno_limits(mno_limits, routing)
+
+        # New transports need their connectors set up before anything can
+        # be routed to them.
+        for connector_name in routing.connectors - self.routing.connectors:
+            if connector_name in self.connectors:
+                # Paused by an earlier reload that removed it.
+                self.connectors[connector_name].unpause()
+                continue
+            connector = yield self.setup_ri_connector(connector_name)
+            connector.set_default_inbound_handler(self._mkhandler(
+                self.process_inbound, self.errback_inbound, connector_name))
+            connector.set_default_event_handler(self._mkhandler(
+                self.process_event, self.errback_event, connector_name))
+            connector.unpause()
+        # Removed transports stop receiving inbound messages but keep their
+        # connectors in case they're mapped again. Their events still need
+        # to reach the application, so only the inbound consumer is paused.
+        for connector_name in self.routing.connectors - routing.connectors:
+            yield self.connectors[connector_name]._consumers[
+                'inbound'].pause()
+
+        changed_mnos = routing.changed_mnos(self.routing)
+        self.routing = routing
+        self.resolve_cache.invalidate_networks(changed_mnos)
+        removed_throttles = self.update_throttles(mno_limits)
+        yield gatherResults(
+            [throttle.flush() for throttle in removed_throttles])
+        log.info('Reloaded mapping, changed MNOs: %s.' % (
+            ', '.join(sorted(changed_mnos)) or 'none',))
+        returnValue(changed_mnos)
+
+    @inlineCallbacks
     def teardown_dispatcher(self):
-        self.portia.transport.loseConnection()
+        if self.previous_signal_handler is not None:
+            signal.signal(self.signum, self.previous_signal_handler)
+        if self.profiler is not None:
+            self.profiler.stop()
+        yield gatherResults(
+            [throttle.flush() for throttle in self.throttles.values()])
+        if self.reconnect_call is not None:
+            self.reconnect_call.cancel()
+        self.connect_d.cancel()
+
+        waiters, self.portia_waiters = self.portia_waiters, []
+        for d in waiters:
+            d.errback(DispatcherError('PortiaDispatcher shutting down.'))
 
+        if self.portia is not None:
+            self.portia.recorder = None
+            self.portia.disconnected_callback = None
+            self.portia.transport.loseConnection()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.redis_cache is not None:
+            yield self.redis_cache.redis.disconnect()
+        if self.health_listener is not None:
+            yield self.health_listener.stopListening()
+
+    @timed_handler
     def process_inbound(self, config, msg, connector_name):
         endpoint_name = msg.get_routing_endpoint()
-        endpoints = config.mapping.get(connector_name)
-        if not endpoints:
+        routing = self.routing
+        if connector_name not in routing.connectors:
             raise DispatcherError('No endpoints configured for %s.' % (
                 connector_name,))
 
-        mno = endpoints.get(endpoint_name)
+        mno = routing.mno_for(connector_name, endpoint_name)
         if not mno:
             raise DispatcherError('No MNO configured for %s:%s.' % (
                 connector_name, endpoint_name))
 
-        d = self.portia.annotate(
-            portia_normalize_msisdn(msg['from_addr']),
-            key='observed-network',
-            value=mno)
-        d.addCallback(
-            lambda _: self.publish_inbound(msg, self.ro_connector, 'default'))
+        # Routing inbound doesn't need Portia so the message is never held
+        # back by it. Acking still waits for the annotate, which never
+        # fails, so that a connected Portia slows down a flood.
+        annotate_d = self.annotate_network(
+            portia_normalize_msisdn(msg['from_addr']), mno)
+        d = self.publish_inbound(msg, self.ro_connector, 'default')
+        d.addCallback(lambda _: annotate_d)
+        return d
+
+    def annotate_network(self, msisdn, mno):
+        self.resolve_cache.set(msisdn, mno)
+        if self.redis_cache is not None:
+            self.redis_cache.set(msisdn, mno, strategy='observed-network')
+        if self.portia is None:
+            # Sent once connected, a full backlog drops the oldest.
+            if len(self.annotate_backlog) == self.annotate_backlog.maxlen:
+                log.warning(
+                    'Not connected to Portia and %s annotates already '
+                    'waiting, dropping the oldest.' % (
+                        len(self.annotate_backlog),))
+            self.annotate_backlog.append((msisdn, mno))
+            return succeed(None)
+        return self.send_annotate(self.portia, msisdn, mno)
+
+    def send_annotate(self, portia, msisdn, mno):
+        d = portia.annotate(msisdn, key='observed-network', value=mno)
+        d.addErrback(log.error, 'Unable to annotate %s with %s.' % (
+            msisdn, mno))
         return d
 
+    def prefix_fallback_lookup(self, msisdn):
+        for prefix, mno in self.fallback_prefixes:
+            if msisdn.startswith(prefix):
+                return mno
+
     @inlineCallbacks
-    def process_outbound(self, config, msg, connector_name):
-        msisdn = portia_normalize_msisdn(msg['to_addr'])
-        response = yield self.portia.resolve(msisdn)
+    def resolve_network(self, msisdn):
+        network = self.resolve_cache.get(msisdn, stale=self.portia is None)
+        if network is None and self.redis_cache is not None:
+            network = yield self.redis_cache.get(msisdn)
+            if network is not None:
+                self.resolve_cache.set(msisdn, network)
+        if network is None and self.portia is None:
+            network = self.prefix_fallback_lookup(msisdn)
+        if network is not None:
+            returnValue(network)
+
+        portia = yield self.get_portia()
+        response = yield portia.resolve(msisdn)
         if not response['network']:
             raise DispatcherError(
                 ('Unable to route outbound message to: %s. '
                  'Portia was unable to resolve: %r.') % (
                     msisdn, response))
-        target = self.reverse_mno_map.get(response['network'])
+        self.resolve_cache.set(msisdn, response['network'])
+        if self.redis_cache is not None:
+            self.redis_cache.set(
+                msisdn, response['network'], strategy=response['strategy'])
+        returnValue(response['network'])
+
+    @timed_handler
+    @inlineCallbacks
+    def process_outbound(self, config, msg, connector_name):
+        network = yield self.resolve_network(
+            portia_normalize_msisdn(msg['to_addr']))
+        target = self.routing.target_for(network)
         if not target:
             raise DispatcherError(
                 ('Unable to route outbound message to: %s. '
                  'No mapping for: %r.') % (
-                    msg['to_addr'], response['network']))
+                    msg['to_addr'], network))
+
+        throttle = self.throttles.get(network)
+        if throttle is not None:
+            yield throttle.submit(
+                self.publish_throttled, msg, target, connector_name)
+            returnValue(msg)
+
         msg = yield self.publish_outbound(msg, target[0], target[1])
         returnValue(msg)
 
+    def publish_throttled(self, msg, target, connector_name):
+        # The handler has already returned by the time a throttled
+        # message is published, so failures are handled here instead.
+        d = self.publish_outbound(msg, target[0], target[1])
+        d.addErrback(self.errback_outbound, msg, connector_name)
+        d.addErrback(self.default_errback, msg, connector_name)
+        return d
+
+    @timed_handler
     def process_event(self, config, event, connector_name):
         return self.publish_event(event, self.ro_connector, 'default')
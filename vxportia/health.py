@@ -0,0 +1,25 @@
+import json
+
+from twisted.web.resource import Resource
+
+
+class HealthResource(Resource):
+
+    isLeaf = True
+
+    def __init__(self, dispatcher):
+        Resource.__init__(self)
+        self.dispatcher = dispatcher
+
+    def render_GET(self, request):
+        # /health only says the worker is alive, /ready also requires
+        # the Portia connection to be up.
+        if request.path not in ('/health', '/ready'):
+            request.setResponseCode(404)
+            return ''
+
+        health = self.dispatcher.health()
+        if request.path == '/ready' and not health['ready']:
+            request.setResponseCode(503)
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(health)
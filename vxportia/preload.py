@@ -0,0 +1,214 @@
+import csv
+import os
+import sys
+
+import click
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    DeferredSemaphore, gatherResults, inlineCallbacks, returnValue)
+from twisted.internet.endpoints import clientFromString
+from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall, coiterate, react
+from twisted.python import log
+
+from vxportia.dispatchers import portia_normalize_msisdn
+from vxportia.protocol import PortiaProtocol, PortiaProtocolException
+
+
+def read_rows(fp, has_header=True, skip=0):
+    # Lazily yields (row_number, msisdn, network) so that arbitrarily
+    # large files never have to be held in memory.
+    reader = csv.reader(fp)
+    if has_header:
+        next(reader, None)
+
+    for row_number, row in enumerate(reader, 1):
+        if row_number <= skip:
+            continue
+        if len(row) < 2 or not row[0].strip() or not row[1].strip():
+            log.msg('Skipping malformed row %s: %r.' % (row_number, row))
+            continue
+        yield row_number, row[0].strip(), row[1].strip()
+
+
+class PortiaPool(object):
+
+    def __init__(self, protocols):
+        self.protocols = protocols
+
+    def pick(self):
+        # Closed connections are dropped, the run is aborted once none
+        # are left.
+        self.protocols = [
+            protocol for protocol in self.protocols if protocol.connected]
+        if not self.protocols:
+            raise PortiaProtocolException('No connections to Portia left.')
+        return min(self.protocols, key=lambda protocol: len(protocol.queue))
+
+    def annotate(self, msisdn, key, value, timestamp=None):
+        return self.pick().annotate(msisdn, key, value, timestamp=timestamp)
+
+    def disconnect(self):
+        for protocol in self.protocols:
+            protocol.transport.loseConnection()
+
+
+def connect_pool(endpoint, size):
+    factory = Factory.forProtocol(PortiaProtocol)
+    d = gatherResults([endpoint.connect(factory) for _ in range(size)])
+    d.addCallback(PortiaPool)
+    return d
+
+
+class Preloader(object):
+
+    clock = reactor
+    report_interval = 5
+
+    def __init__(self, pool, key='observed-network', window=100,
+                 checkpoint_path=None):
+        self.pool = pool
+        self.key = key
+        self.window = window
+        self.checkpoint_path = checkpoint_path
+        self.semaphore = DeferredSemaphore(window)
+        self.in_flight = {}
+        self.position = 0
+        self.loaded = 0
+        self.failed = 0
+        self.oldest_failed = None
+        self.started = None
+        self.last_report = (None, 0)
+
+    def read_checkpoint(self):
+        if not (self.checkpoint_path and
+                os.path.exists(self.checkpoint_path)):
+            return 0
+        with open(self.checkpoint_path) as fp:
+            return int(fp.read().strip() or 0)
+
+    def checkpoint(self):
+        # Rows complete out of order, everything before the oldest
+        # row still in flight or failed is safe to skip when resuming.
+        rows = list(self.in_flight)
+        if self.oldest_failed is not None:
+            rows.append(self.oldest_failed)
+        if rows:
+            return min(rows) - 1
+        return self.position
+
+    def write_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        tmp_path = '%s.tmp' % (self.checkpoint_path,)
+        with open(tmp_path, 'w') as fp:
+            fp.write('%s\n' % (self.checkpoint(),))
+        os.rename(tmp_path, self.checkpoint_path)
+
+    def report(self):
+        now = self.clock.seconds()
+        last_time, last_count = self.last_report
+        done = self.loaded + self.failed
+        recent = float(done - last_count) / max(now - last_time, 0.001)
+        overall = float(done) / max(now - self.started, 0.001)
+        log.msg(
+            ('Preloaded %s rows (%s failed) at %.1f rows/s, %.1f rows/s '
+             'overall, checkpoint at row %s.') % (
+                self.loaded, self.failed, recent, overall,
+                self.checkpoint()))
+        self.last_report = (now, done)
+        self.write_checkpoint()
+
+    def annotate_ok(self, result):
+        self.loaded += 1
+
+    def annotate_failed(self, failure, row_number, msisdn):
+        self.failed += 1
+        self.oldest_failed = min(self.oldest_failed or row_number, row_number)
+        log.err(failure, 'Unable to preload row %s: %s.' % (
+            row_number, msisdn))
+
+    def release(self, result, row_number):
+        del self.in_flight[row_number]
+        self.semaphore.release()
+
+    def annotate_rows(self, rows):
+        for row_number, msisdn, network in rows:
+            # Yielding to the cooperator here stops reading from the file
+            # while the in-flight window is full.
+            yield self.semaphore.acquire()
+            d = self.pool.annotate(
+                portia_normalize_msisdn(msisdn), key=self.key, value=network)
+            self.in_flight[row_number] = d
+            self.position = row_number
+            d.addCallbacks(
+                self.annotate_ok, self.annotate_failed,
+                errbackArgs=(row_number, msisdn))
+            d.addBoth(self.release, row_number)
+
+    @inlineCallbacks
+    def run(self, rows, skip=0):
+        # `skip` is where `rows` resume from, the checkpoint never goes
+        # back before it.
+        self.position = skip
+        self.started = self.clock.seconds()
+        self.last_report = (self.started, 0)
+        reporter = LoopingCall(self.report)
+        reporter.clock = self.clock
+        reporter.start(self.report_interval, now=False)
+        try:
+            yield coiterate(self.annotate_rows(rows))
+            yield gatherResults(self.in_flight.values())
+        finally:
+            reporter.stop()
+            self.report()
+        returnValue((self.loaded, self.failed))
+
+
+@click.command()
+@click.option('--endpoint', default='tcp:localhost:8001',
+              help='The Twisted Endpoint of the Portia TCP server.',
+              type=str)
+@click.option('--connections', default=4,
+              help='How many connections to Portia to spread load over.',
+              type=int)
+@click.option('--window', default=200,
+              help='The maximum number of annotates in flight.',
+              type=int)
+@click.option('--key', default='observed-network',
+              help='The annotation key to store the network under.',
+              type=str)
+@click.option('--header/--no-header', default=True,
+              help='Whether the CSV file has a header or not.')
+@click.option('--checkpoint', default=None,
+              help='File to record progress in, used to resume.',
+              type=click.Path())
+@click.option('--report-interval', default=5.0,
+              help='Seconds between progress reports.',
+              type=float)
+@click.option('--logfile',
+              help='Where to log output to.',
+              type=click.File('a'),
+              default=sys.stdout)
+@click.argument('file', type=click.File())
+def main(endpoint, connections, window, key, header, checkpoint,
+         report_interval, logfile, file):
+    log.startLogging(logfile)
+
+    @inlineCallbacks
+    def preload(reactor):
+        pool = yield connect_pool(
+            clientFromString(reactor, str(endpoint)), connections)
+        preloader = Preloader(
+            pool, key=key, window=window, checkpoint_path=checkpoint)
+        preloader.report_interval = report_interval
+        reactor.addSystemEventTrigger(
+            'before', 'shutdown', preloader.write_checkpoint)
+        skip = preloader.read_checkpoint()
+        try:
+            yield preloader.run(read_rows(file, header, skip=skip), skip=skip)
+        finally:
+            pool.disconnect()
+
+    react(preload)
@@ -0,0 +1,171 @@
+import os
+import signal
+from collections import Counter
+from functools import wraps
+
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred
+from twisted.python import log
+
+
+def timed_handler(func):
+    # Wraps a dispatcher handler so that its time to completion is
+    # recorded whenever the dispatcher has a profiler configured.
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.profiler is None:
+            return func(self, *args, **kwargs)
+        return self.profiler.time_call(
+            func.__name__, func, self, *args, **kwargs)
+    return wrapper
+
+
+class HandlerStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, duration, error=False):
+        self.count += 1
+        self.errors += int(error)
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class DispatcherProfiler(object):
+
+    clock = reactor
+    max_stack_depth = 64
+
+    def __init__(self, lag_interval=1.0, report_interval=60.0,
+                 sample_interval=0.01, sample_duration=30.0,
+                 dump_path='vxportia-profile-%(pid)s-%(timestamp)d.txt'):
+        self.lag_interval = lag_interval
+        self.report_interval = report_interval
+        self.sample_interval = sample_interval
+        self.sample_duration = sample_duration
+        self.dump_path = dump_path
+
+        self.handler_stats = {}
+        self.lag_stats = HandlerStats()
+        self.samples = Counter()
+        self.sampling_call = None
+        self.lag_call = None
+        self.report_call = None
+        self.expected_probe = None
+        self.previous_signal_handler = None
+        self.signum = None
+
+    def start(self):
+        self.probe()
+        self.report_call = self.clock.callLater(
+            self.report_interval, self.report)
+
+    def stop(self):
+        for delayed_call in (self.lag_call, self.report_call):
+            if delayed_call is not None and delayed_call.active():
+                delayed_call.cancel()
+        if self.sampling_call is not None:
+            self.stop_sampling()
+        if self.signum is not None:
+            signal.signal(self.signum, self.previous_signal_handler)
+            self.signum = None
+
+    def time_call(self, name, func, *args, **kwargs):
+        started = self.clock.seconds()
+        stats = self.handler_stats.setdefault(name, HandlerStats())
+
+        def record(result, error):
+            stats.record(self.clock.seconds() - started, error=error)
+            return result
+
+        d = maybeDeferred(func, *args, **kwargs)
+        d.addCallbacks(
+            record, record, callbackArgs=(False,), errbackArgs=(True,))
+        return d
+
+    def probe(self):
+        # The reactor runs this probe late by however long it was busy
+        # running other things, that delay is the reactor lag.
+        now = self.clock.seconds()
+        if self.expected_probe is not None:
+            self.lag_stats.record(max(0.0, now - self.expected_probe))
+        self.expected_probe = now + self.lag_interval
+        self.lag_call = self.clock.callLater(self.lag_interval, self.probe)
+
+    def report(self):
+        log.msg(
+            'Reactor lag: mean %.4fs, max %.4fs over %s probes.' % (
+                self.lag_stats.mean(), self.lag_stats.max,
+                self.lag_stats.count))
+        for name, stats in sorted(self.handler_stats.items()):
+            log.msg(
+                ('Handler %s: %s calls, %s errors, mean %.4fs, '
+                 'max %.4fs.') % (
+                    name, stats.count, stats.errors, stats.mean(),
+                    stats.max))
+        self.lag_stats = HandlerStats()
+        self.handler_stats = {}
+        self.report_call = self.clock.callLater(
+            self.report_interval, self.report)
+
+    def install_signal_handler(self, signal_name):
+        self.signum = getattr(signal, signal_name)
+        self.previous_signal_handler = signal.signal(
+            self.signum, self.handle_signal)
+
+    def handle_signal(self, signum, frame):
+        # Signal handlers can interrupt the reactor at any point, hand
+        # the actual work back to it.
+        reactor.callFromThread(self.start_sampling)
+
+    def start_sampling(self):
+        if self.sampling_call is not None:
+            return
+        self.samples = Counter()
+        signal.signal(signal.SIGPROF, self.sample)
+        # Python 2 doesn't retry system calls interrupted by a signal,
+        # without this sampling can make blocking writes fail with EINTR.
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(
+            signal.ITIMER_PROF, self.sample_interval, self.sample_interval)
+        self.sampling_call = self.clock.callLater(
+            self.sample_duration, self.stop_sampling)
+        log.msg('Sampling profiler started for %ss.' % (
+            self.sample_duration,))
+
+    def stop_sampling(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        signal.siginterrupt(signal.SIGPROF, True)
+        if self.sampling_call.active():
+            self.sampling_call.cancel()
+        self.sampling_call = None
+        return self.dump()
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_stack_depth:
+            code = frame.f_code
+            stack.append('%s:%s' % (code.co_filename, code.co_name))
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def dump(self):
+        # Written in the collapsed stack format used by flamegraph tools.
+        path = self.dump_path % {
+            'pid': os.getpid(),
+            'timestamp': self.clock.seconds(),
+        }
+        with open(path, 'w') as fp:
+            for stack, count in self.samples.most_common():
+                fp.write('%s %s\n' % (stack, count))
+        log.msg('Sampling profiler wrote %s samples to %s.' % (
+            sum(self.samples.values()), path))
+        return path
@@ -1,8 +1,9 @@
 import json
+from collections import deque
 from uuid import uuid4
 
 from twisted.internet import reactor
-from twisted.internet.defer import maybeDeferred, Deferred
+from twisted.internet.defer import maybeDeferred, Deferred, fail
 from twisted.protocols.basic import LineReceiver
 from twisted.python import log
 
@@ -18,16 +19,46 @@ class PortiaProtocol(LineReceiver):
     version = "0.1.0"
     timeout = 10
     clock = reactor
+    # Commands are sent in order of priority, lower goes first. With no
+    # limit on commands in flight everything is sent immediately.
+    priorities = {
+        'resolve': 0,
+        'get': 0,
+        'annotate': 1,
+    }
+    default_priority = 1
+    max_in_flight = None
+    # How often a waiting lower priority command can be passed over
+    # before it gets sent regardless.
+    starvation_limit = 10
+    # How many commands of each priority may wait to be sent before
+    # further commands of that priority are refused. Unlimited if None.
+    max_queued = None
+    recorder = None
+    # Called with the protocol and the reason when the connection is lost.
+    disconnected_callback = None
 
     def __init__(self):
         self.queue = {}
+        self.in_flight = set()
+        self.timeouts = {}
+        self.send_queues = [
+            deque() for _ in range(max(self.priorities.values()) + 1)]
+        self.skipped = [0] * len(self.send_queues)
 
     def force_timeout(self, reference_id):
         d = self.queue.pop(reference_id, None)
+        self.command_done(reference_id)
         if d and not d.called:
             d.errback(PortiaProtocolException('Timeout exceeded.'))
 
     def send_command(self, cmd, reference_id=None, **kwargs):
+        # Limited per priority so that a flood of annotates can't crowd
+        # out resolves.
+        priority = self.priorities.get(cmd, self.default_priority)
+        if (self.max_queued is not None and not self.can_send() and
+                len(self.send_queues[priority]) >= self.max_queued):
+            return fail(PortiaProtocolException('Send queue full.'))
         reference_id = reference_id or uuid4().hex
         data = {
             "cmd": cmd,
@@ -37,11 +68,61 @@ class PortiaProtocol(LineReceiver):
             "request": kwargs,
         }
         d = Deferred()
-        self.clock.callLater(self.timeout, self.force_timeout, reference_id)
         self.queue[reference_id] = d
-        self.sendLine(json.dumps(data))
+        self.send_queues[priority].append((reference_id, json.dumps(data)))
+        self.send_queued()
         return d
 
+    def can_send(self):
+        return (self.max_in_flight is None or
+                len(self.in_flight) < self.max_in_flight)
+
+    def next_queued(self):
+        waiting = [priority
+                   for priority, send_queue in enumerate(self.send_queues)
+                   if send_queue]
+        starved = [priority for priority in waiting
+                   if self.skipped[priority] >= self.starvation_limit]
+        priority = (starved or waiting)[0]
+        for passed_over in waiting:
+            if passed_over > priority:
+                self.skipped[passed_over] += 1
+        self.skipped[priority] = 0
+        return self.send_queues[priority].popleft()
+
+    def send_queued(self):
+        while self.can_send() and any(self.send_queues):
+            reference_id, line = self.next_queued()
+            # The timeout only covers waiting for Portia, not waiting in
+            # the send queue.
+            self.in_flight.add(reference_id)
+            self.timeouts[reference_id] = self.clock.callLater(
+                self.timeout, self.force_timeout, reference_id)
+            if self.recorder is not None:
+                self.recorder.request(reference_id, line)
+            self.sendLine(line)
+
+    def connectionLost(self, reason):
+        self.connected = 0
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self, reason)
+        queue, self.queue = self.queue, {}
+        self.in_flight.clear()
+        timeouts, self.timeouts = self.timeouts, {}
+        for delayed_call in timeouts.values():
+            delayed_call.cancel()
+        for send_queue in self.send_queues:
+            send_queue.clear()
+        for d in queue.values():
+            d.errback(PortiaProtocolException('Connection lost.'))
+
+    def command_done(self, reference_id):
+        self.in_flight.discard(reference_id)
+        delayed_call = self.timeouts.pop(reference_id, None)
+        if delayed_call is not None and delayed_call.active():
+            delayed_call.cancel()
+        self.send_queued()
+
     def lineReceived(self, line):
         d = maybeDeferred(self.parseLine, line)
         d.addErrback(log.err)
@@ -50,7 +131,10 @@ class PortiaProtocol(LineReceiver):
         data = json.loads(line)
         status = data['status']
         reference_id = data['reference_id']
+        if self.recorder is not None:
+            self.recorder.reply(reference_id, line)
         d = self.queue.pop(reference_id, None)
+        self.command_done(reference_id)
         if d is None:
             raise PortiaProtocolException(data)
         if status == 'ok':
@@ -0,0 +1,94 @@
+import gzip
+import json
+import zlib
+from io import BytesIO
+
+from twisted.internet import reactor
+
+
+def open_recording(path, mode='r'):
+    if path.endswith('.gz'):
+        if mode == 'r':
+            return read_gzip(path)
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def read_gzip(path):
+    # Unlike gzip.open this keeps everything before a truncated end, as
+    # left behind by a worker that was killed while recording. Appending
+    # to a recording adds a gzip member each time.
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    chunks = []
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return BytesIO(''.join(chunks))
+
+
+class TrafficRecorder(object):
+    # Writes one line per request or reply sent over a PortiaProtocol:
+    #
+    #   <timestamp> <direction> <reference_id> <line>
+    #
+    # where direction is `>` for requests and `<` for replies.
+
+    clock = reactor
+    # Seconds between flushes, so that little is lost if the worker is
+    # killed before the recording is closed.
+    flush_interval = 5
+
+    def __init__(self, fp, sample_rate=1.0):
+        self.fp = fp
+        self.sample_rate = sample_rate
+        self.last_flush = None
+
+    def sampled(self, reference_id):
+        # Decided by the reference id so that a reply is recorded exactly
+        # when its request was.
+        checksum = zlib.crc32(reference_id) & 0xffffffff
+        return checksum < self.sample_rate * 0x100000000
+
+    def write(self, direction, reference_id, line):
+        if reference_id and self.sampled(reference_id):
+            now = self.clock.seconds()
+            self.fp.write('%.6f %s %s %s\n' % (
+                now, direction, reference_id, line))
+            if self.last_flush is None:
+                self.last_flush = now
+            elif now - self.last_flush >= self.flush_interval:
+                self.fp.flush()
+                self.last_flush = now
+
+    def request(self, reference_id, line):
+        self.write('>', reference_id, line)
+
+    def reply(self, reference_id, line):
+        self.write('<', reference_id, line)
+
+    def close(self):
+        self.fp.close()
+
+
+def read_recording(fp):
+    # Pairs up recorded requests with their replies, returning a list of
+    # (timestamp, request, reply delay, reply) in the order the requests
+    # were sent. Requests without a recorded reply are left out.
+    requests = {}
+    exchanges = []
+    for line in fp:
+        if not line.endswith('\n'):
+            # Cut off while being written.
+            break
+        timestamp, direction, reference_id, data = line.rstrip('\n').split(
+            ' ', 3)
+        if direction == '>':
+            requests[reference_id] = (float(timestamp), json.loads(data))
+        elif reference_id in requests:
+            sent, request = requests.pop(reference_id)
+            exchanges.append(
+                (sent, request, float(timestamp) - sent, json.loads(data)))
+    exchanges.sort(key=lambda exchange: exchange[0])
+    return exchanges
@@ -0,0 +1,206 @@
+import json
+import sys
+from collections import defaultdict, deque
+
+import click
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    DeferredSemaphore, gatherResults, inlineCallbacks, returnValue)
+from twisted.internet.endpoints import clientFromString, serverFromString
+from twisted.internet.protocol import Factory
+from twisted.internet.task import coiterate, deferLater, react
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+from vxportia.protocol import PortiaProtocol
+from vxportia.recording import open_recording, read_recording
+
+
+def request_key(request):
+    return (request['cmd'], json.dumps(request['request'], sort_keys=True))
+
+
+class ReplayPortiaProtocol(LineReceiver):
+
+    def lineReceived(self, line):
+        request = json.loads(line)
+        reply, delay = self.factory.next_reply(request)
+        if reply is None:
+            reply = {
+                'status': 'error',
+                'cmd': 'reply',
+                'reference_cmd': request['cmd'],
+                'version': request['version'],
+                'message': 'No recorded reply for this request.',
+            }
+        reply = dict(reply, reference_id=request['id'])
+        self.factory.clock.callLater(delay, self.sendLine, json.dumps(reply))
+
+
+class ReplayPortiaFactory(Factory):
+    # Answers requests with the replies recorded for identical requests,
+    # after the recorded delay divided by `speed`. A speed of 0 replies
+    # immediately.
+
+    protocol = ReplayPortiaProtocol
+    clock = reactor
+
+    def __init__(self, exchanges, speed=1.0):
+        self.speed = speed
+        self.replies = defaultdict(deque)
+        for _, request, delay, reply in exchanges:
+            self.replies[request_key(request)].append((reply, delay))
+
+    def next_reply(self, request):
+        replies = self.replies.get(request_key(request))
+        if not replies:
+            return None, 0
+        reply, delay = replies[0]
+        # Cycle through the recorded replies so that a recording can be
+        # replayed more than once.
+        replies.rotate(-1)
+        return reply, (delay / self.speed if self.speed else 0)
+
+
+class ReplayDriver(object):
+    # Sends recorded requests to Portia at their recorded times divided by
+    # `speed`, a speed of 0 sends them as fast as the window allows.
+
+    clock = reactor
+
+    def __init__(self, portia, exchanges, speed=1.0, window=100):
+        self.portia = portia
+        self.exchanges = exchanges
+        self.speed = speed
+        self.semaphore = DeferredSemaphore(window)
+        self.pending = set()
+        self.latencies = []
+        self.errors = 0
+
+    def send(self, request):
+        started = self.clock.seconds()
+
+        def ok(_):
+            self.latencies.append(self.clock.seconds() - started)
+
+        def failed(failure):
+            self.errors += 1
+
+        def done(_):
+            self.pending.discard(d)
+            self.semaphore.release()
+
+        d = self.portia.send_command(request['cmd'], **request['request'])
+        self.pending.add(d)
+        d.addCallbacks(ok, failed)
+        d.addBoth(done)
+
+    def send_all(self):
+        started = self.clock.seconds()
+        first = self.exchanges[0][0] if self.exchanges else 0
+        for sent, request, _, _ in self.exchanges:
+            if self.speed:
+                wait = (started + (sent - first) / self.speed -
+                        self.clock.seconds())
+                if wait > 0:
+                    yield deferLater(self.clock, wait, lambda: None)
+            yield self.semaphore.acquire()
+            self.send(request)
+
+    def stats(self, elapsed):
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return 0.0
+            return latencies[min(
+                int(len(latencies) * fraction), len(latencies) - 1)]
+
+        return {
+            'requests': len(latencies) + self.errors,
+            'errors': self.errors,
+            'elapsed': elapsed,
+            'rate': (len(latencies) + self.errors) / max(elapsed, 0.001),
+            'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+            'p50': percentile(0.5),
+            'p99': percentile(0.99),
+        }
+
+    @inlineCallbacks
+    def run(self):
+        started = self.clock.seconds()
+        yield coiterate(self.send_all())
+        yield gatherResults(list(self.pending))
+        returnValue(self.stats(self.clock.seconds() - started))
+
+
+def load_exchanges(path):
+    with open_recording(path) as fp:
+        return read_recording(fp)
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.option('--endpoint', default='tcp:8001',
+              help='The Twisted Endpoint to serve recorded replies on.',
+              type=str)
+@click.option('--speed', default=1.0,
+              help='How many times faster than recorded to reply, '
+                   '0 replies immediately.',
+              type=float)
+@click.option('--logfile',
+              help='Where to log output to.',
+              type=click.File('a'),
+              default=sys.stdout)
+@click.argument('recording', type=click.Path(exists=True))
+def serve(endpoint, speed, logfile, recording):
+    log.startLogging(logfile)
+    factory = ReplayPortiaFactory(load_exchanges(recording), speed=speed)
+    d = serverFromString(reactor, str(endpoint)).listen(factory)
+    d.addCallback(lambda port: log.msg(
+        'Replaying %s recorded requests on %s.' % (
+            sum(map(len, factory.replies.values())), port.getHost())))
+    d.addErrback(lambda failure: (log.err(failure), reactor.stop()))
+    reactor.run()
+
+
+@main.command()
+@click.option('--endpoint', default='tcp:localhost:8001',
+              help='The Twisted Endpoint of the Portia TCP server.',
+              type=str)
+@click.option('--speed', default=1.0,
+              help='How many times faster than recorded to send, '
+                   '0 sends as fast as possible.',
+              type=float)
+@click.option('--window', default=100,
+              help='The maximum number of requests in flight.',
+              type=int)
+@click.option('--logfile',
+              help='Where to log output to.',
+              type=click.File('a'),
+              default=sys.stdout)
+@click.argument('recording', type=click.Path(exists=True))
+def drive(endpoint, speed, window, logfile, recording):
+    log.startLogging(logfile)
+
+    @inlineCallbacks
+    def replay(reactor):
+        portia = yield clientFromString(reactor, str(endpoint)).connect(
+            Factory.forProtocol(PortiaProtocol))
+        driver = ReplayDriver(
+            portia, load_exchanges(recording), speed=speed, window=window)
+        try:
+            stats = yield driver.run()
+        finally:
+            portia.transport.loseConnection()
+        log.msg(
+            ('Replayed %(requests)s requests (%(errors)s errors) in '
+             '%(elapsed).2fs, %(rate).1f requests/s, latency mean '
+             '%(mean).4fs, p50 %(p50).4fs, p99 %(p99).4fs.') % stats)
+
+    react(replay)
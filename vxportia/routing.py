@@ -0,0 +1,49 @@
+from vumi.errors import DispatcherError
+
+
+class RoutingTable(object):
+    # Compiled once from the mapping config and never modified afterwards,
+    # a reload builds a new table and swaps it in.
+
+    def __init__(self, mnos, targets):
+        self._mnos = mnos
+        self._targets = targets
+        self.connectors = frozenset(
+            connector for connector, _ in mnos.keys())
+
+    @classmethod
+    def compile(cls, mapping, receive_inbound_connectors):
+        mnos = {}
+        targets = {}
+        declared_mnos = []
+        for transport, endpoints in mapping.items():
+            for endpoint, mno in endpoints.items():
+                declared_mnos.append(mno)
+                mnos[(transport, endpoint)] = mno
+                targets[mno] = (transport, endpoint)
+
+        if len(set(declared_mnos)) != len(declared_mnos):
+            raise DispatcherError('PortiaDispatcher mappings are not unique.')
+
+        mapped_transports = set(transport for transport, _ in mnos.keys())
+        if mapped_transports != set(receive_inbound_connectors):
+            raise DispatcherError(
+                'Not all receive_inbound_connectors mapped to MNOs.')
+
+        return cls(mnos, targets)
+
+    @property
+    def mno_names(self):
+        return frozenset(self._targets.keys())
+
+    def mno_for(self, connector_name, endpoint_name):
+        return self._mnos.get((connector_name, endpoint_name))
+
+    def target_for(self, mno):
+        return self._targets.get(mno)
+
+    def changed_mnos(self, other):
+        # MNOs that were added, removed or now route somewhere else.
+        return set(
+            mno for mno in self.mno_names | other.mno_names
+            if self.target_for(mno) != other.target_for(mno))
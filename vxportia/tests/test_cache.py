@@ -0,0 +1,142 @@
+from portia.utils import start_redis
+
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxportia.cache import RedisResolveCache, ResolveCache
+
+
+class TestResolveCache(TestCase):
+
+    def get_cache(self, size=10, ttl=60):
+        cache = ResolveCache(size, ttl)
+        cache.clock = Clock()
+        return cache
+
+    def test_get_set(self):
+        cache = self.get_cache()
+        self.assertEqual(cache.get('27123456789'), None)
+        cache.set('27123456789', 'MTN')
+        self.assertEqual(cache.get('27123456789'), 'MTN')
+        self.assertEqual(len(cache), 1)
+
+    def test_disabled(self):
+        cache = self.get_cache(size=0)
+        cache.set('27123456789', 'MTN')
+        self.assertEqual(cache.get('27123456789'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_expiry(self):
+        cache = self.get_cache()
+        cache.set('27123456789', 'MTN')
+        cache.clock.advance(60)
+        self.assertEqual(cache.get('27123456789'), None)
+        self.assertEqual(cache.get('27123456789', stale=True), 'MTN')
+
+    def test_eviction(self):
+        cache = self.get_cache(size=2)
+        cache.set('27123456781', 'MTN')
+        cache.set('27123456782', 'MTN')
+        cache.set('27123456781', 'CELLC')
+        cache.set('27123456783', 'MTN')
+        self.assertEqual(
+            cache.entries.keys(), ['27123456781', '27123456783'])
+
+    def test_invalidate_networks(self):
+        cache = self.get_cache()
+        cache.set('27123456781', 'MTN')
+        cache.set('27123456782', 'CELLC')
+        cache.set('27123456783', 'VODACOM')
+        cache.invalidate_networks(set(['CELLC', 'VODACOM']))
+        self.assertEqual(cache.entries.keys(), ['27123456781'])
+
+
+class StalledRedis(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def mget(self, keys):
+        d = Deferred()
+        self.calls.append((keys, d))
+        return d
+
+
+class TestRedisResolveCache(TestCase):
+
+    timeout = 1
+
+    @inlineCallbacks
+    def setUp(self):
+        self.redis = yield start_redis()
+        self.addCleanup(self.redis.disconnect)
+        self.addCleanup(self.flush)
+        self.cache = RedisResolveCache(
+            self.redis, prefix='test:resolve:',
+            ttls={'ported-to': 1000}, default_ttl=10)
+
+    @inlineCallbacks
+    def flush(self):
+        keys = yield self.redis.keys('test:resolve:*')
+        if keys:
+            yield self.redis.delete(*keys)
+
+    @inlineCallbacks
+    def test_get_set(self):
+        network = yield self.cache.get('27123456789')
+        self.assertEqual(network, None)
+        yield self.cache.set('27123456789', 'MTN')
+        network = yield self.cache.get('27123456789')
+        self.assertEqual(network, 'MTN')
+
+    @inlineCallbacks
+    def test_ttls(self):
+        yield self.cache.set('27123456781', 'MTN', strategy='ported-to')
+        yield self.cache.set(
+            '27123456782', 'MTN', strategy='observed-network')
+        ttl = yield self.redis.ttl('test:resolve:27123456781')
+        self.assertEqual(ttl, 1000)
+        ttl = yield self.redis.ttl('test:resolve:27123456782')
+        self.assertEqual(ttl, 10)
+
+    @inlineCallbacks
+    def test_get_many(self):
+        yield self.cache.set('27123456781', 'MTN')
+        yield self.cache.set('27123456782', 'CELLC')
+        networks = yield self.cache.get_many(
+            ['27123456781', '27123456782', '27123456783'])
+        self.assertEqual(networks, {
+            '27123456781': 'MTN',
+            '27123456782': 'CELLC',
+            '27123456783': None,
+        })
+
+    def test_batching(self):
+        redis = StalledRedis()
+        cache = RedisResolveCache(redis, prefix='test:')
+        cache.clock = Clock()
+        d1 = cache.get('1')
+        d2 = cache.get('2')
+        d3 = cache.get('2')
+        self.assertEqual([keys for keys, _ in redis.calls], [['test:1']])
+
+        redis.calls[0][1].callback(['MTN'])
+        self.assertEqual(self.successResultOf(d1), 'MTN')
+        self.assertEqual(
+            [sorted(keys) for keys, _ in redis.calls],
+            [['test:1'], ['test:2']])
+        redis.calls[1][1].callback(['CELLC'])
+        self.assertEqual(self.successResultOf(d2), 'CELLC')
+        self.assertEqual(self.successResultOf(d3), 'CELLC')
+
+    def test_timeout(self):
+        redis = StalledRedis()
+        cache = RedisResolveCache(redis, timeout=0.1)
+        cache.clock = Clock()
+        d = cache.get('1')
+        self.assertNoResult(d)
+        cache.clock.advance(0.1)
+        self.assertEqual(self.successResultOf(d), None)
+        redis.calls[0][1].callback(['MTN'])
+        self.assertFalse(cache.fetching)
@@ -1,17 +1,48 @@
 import pkg_resources
 
+import yaml
+
 from portia.portia import Portia
 from portia.utils import (
     start_redis, start_tcpserver, compile_network_prefix_mappings)
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred, fail
+from twisted.internet.endpoints import clientFromString
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.interfaces import IStreamClientEndpoint
 from twisted.internet.task import Clock
+from twisted.internet import reactor
+
+from zope.interface import implementer
 
 from vumi.dispatchers.tests.helpers import DispatcherHelper
 from vumi.errors import DispatcherError
 from vumi.tests.helpers import VumiTestCase
 
 from vxportia.dispatchers import PortiaDispatcher, portia_normalize_msisdn
+from vxportia.recording import read_recording
+
+
+@implementer(IStreamClientEndpoint)
+class PendingEndpoint(object):
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.attempts = []
+
+    def connect(self, factory):
+        d = Deferred()
+        self.attempts.append((d, factory))
+        return d
+
+    def accept(self):
+        d, factory = self.attempts.pop(0)
+        self.endpoint.connect(factory).chainDeferred(d)
+        return d
+
+    def refuse(self):
+        d, factory = self.attempts.pop(0)
+        d.errback(ConnectionRefusedError())
 
 
 class TestPortiaDispatcher(VumiTestCase):
@@ -35,7 +66,7 @@ class TestPortiaDispatcher(VumiTestCase):
         self.listener_port = self.listener.getHost().port
 
         # NOTE: setting the clock before the setup_dispatcher stuff is called
-        PortiaDispatcher.clock = Clock()
+        self.clock = PortiaDispatcher.clock = Clock()
         self.disp_helper = self.add_helper(DispatcherHelper(PortiaDispatcher))
 
     def get_dispatcher(self, **config_extras):
@@ -56,6 +87,10 @@ class TestPortiaDispatcher(VumiTestCase):
         config.update(config_extras)
         return self.disp_helper.get_dispatcher(config)
 
+    def get_pending_endpoint(self):
+        return PendingEndpoint(clientFromString(
+            reactor, "tcp:%s:%s" % (self.listener_host, self.listener_port)))
+
     def ch(self, connector_name):
         return self.disp_helper.get_connector_helper(connector_name)
 
@@ -108,7 +143,8 @@ class TestPortiaDispatcher(VumiTestCase):
         resolve_response = yield self.portia.resolve(
             portia_normalize_msisdn(from_addr))
         self.assertEqual(resolve_response['network'], None)
-        yield self.get_dispatcher()
+        dispatcher = yield self.get_dispatcher()
+        yield dispatcher.get_portia()
         msg = yield self.ch("transport1").make_dispatch_inbound(
             "inbound", from_addr=from_addr)
         self.assert_rkeys_used('transport1.inbound', 'app1.inbound')
@@ -118,6 +154,20 @@ class TestPortiaDispatcher(VumiTestCase):
             portia_normalize_msisdn(from_addr))
         self.assertEqual(resolve_response['network'], 'mno1')
 
+    @inlineCallbacks
+    def test_inbound_message_annotate_failed(self):
+        dispatcher = yield self.get_dispatcher(
+            portia_max_in_flight=1, portia_max_queued=0)
+        portia = yield dispatcher.get_portia()
+        # NOTE: an annotate already in flight fills the send queue
+        portia.annotate('27123456780', key='observed-network', value='mno2')
+        msg = yield self.ch("transport1").make_dispatch_inbound(
+            "inbound", from_addr='+27123456789')
+        self.assert_dispatched_endpoint(
+            msg, 'default', self.ch('app1').get_dispatched_inbound())
+        [failure] = self.flushLoggedErrors()
+        self.assertEqual(failure.value.message, 'Send queue full.')
+
     @inlineCallbacks
     def test_inbound_event_routing(self):
         yield self.get_dispatcher()
@@ -167,3 +217,423 @@ class TestPortiaDispatcher(VumiTestCase):
         self.assertTrue(
             "Unable to route outbound message to:"
             in failure.getErrorMessage())
+
+    @inlineCallbacks
+    def test_profiling_handler_timings(self):
+        dispatcher = yield self.get_dispatcher(profiling=True)
+        yield self.ch('transport1').make_dispatch_ack()
+        yield self.ch("transport1").make_dispatch_inbound(
+            "inbound", from_addr='+27123456789')
+        stats = dispatcher.profiler.handler_stats
+        self.assertEqual(stats['process_event'].count, 1)
+        self.assertEqual(stats['process_inbound'].count, 1)
+        self.assertEqual(stats['process_inbound'].errors, 0)
+
+    @inlineCallbacks
+    def test_profiling_disabled(self):
+        dispatcher = yield self.get_dispatcher()
+        self.assertEqual(dispatcher.profiler, None)
+
+    @inlineCallbacks
+    def test_portia_send_queue_config(self):
+        dispatcher = yield self.get_dispatcher(
+            portia_max_in_flight=5, portia_max_queued=10,
+            portia_starvation_limit=3)
+        portia = yield dispatcher.get_portia()
+        self.assertEqual(portia.max_in_flight, 5)
+        self.assertEqual(portia.max_queued, 10)
+        self.assertEqual(portia.starvation_limit, 3)
+
+    @inlineCallbacks
+    def test_startup_without_portia(self):
+        endpoint = self.get_pending_endpoint()
+        dispatcher = yield self.get_dispatcher(portia_endpoint=endpoint)
+        self.assertFalse(dispatcher.is_ready())
+
+        msg = yield self.ch("transport1").make_dispatch_inbound(
+            "inbound", from_addr='+27123456789')
+        self.assert_dispatched_endpoint(
+            msg, 'default', self.ch('app1').get_dispatched_inbound())
+        self.assertEqual(dispatcher.health(), {
+            'ready': False,
+            'waiting': 0,
+            'annotates_waiting': 1,
+            'cached': 0,
+            'buffered': {},
+        })
+
+        sent = []
+        send_annotate_backlog = dispatcher.send_annotate_backlog
+        self.patch(dispatcher, 'send_annotate_backlog', lambda portia: (
+            sent.append(send_annotate_backlog(portia)) or sent[-1]))
+        yield endpoint.accept()
+        self.assertTrue(dispatcher.is_ready())
+        yield sent[0]
+        self.assertEqual(dispatcher.health()['annotates_waiting'], 0)
+        resolve_response = yield self.portia.resolve('27123456789')
+        self.assertEqual(resolve_response['network'], 'mno1')
+
+    @inlineCallbacks
+    def test_annotate_backlog_full(self):
+        endpoint = self.get_pending_endpoint()
+        dispatcher = yield self.get_dispatcher(
+            portia_endpoint=endpoint, portia_buffer_size=1)
+        for from_addr in ['+27123456781', '+27123456782']:
+            yield self.ch("transport1").make_dispatch_inbound(
+                "inbound", from_addr=from_addr)
+        self.assertEqual(len(self.ch('app1').get_dispatched_inbound()), 2)
+        self.assertEqual(
+            list(dispatcher.annotate_backlog), [('27123456782', 'mno1')])
+
+    @inlineCallbacks
+    def test_reconnect_after_failed_connect(self):
+        endpoint = self.get_pending_endpoint()
+        dispatcher = yield self.get_dispatcher(portia_endpoint=endpoint)
+        endpoint.refuse()
+        self.assertEqual(endpoint.attempts, [])
+        self.clock.advance(dispatcher.initial_reconnect_delay)
+        yield endpoint.accept()
+        self.assertTrue(dispatcher.is_ready())
+
+    @inlineCallbacks
+    def test_reconnect_after_connection_lost(self):
+        endpoint = self.get_pending_endpoint()
+        dispatcher = yield self.get_dispatcher(
+            portia_endpoint=endpoint,
+            prefix_fallback={'27': 'mno1', '27123': 'mno2'})
+        yield endpoint.accept()
+        portia = yield dispatcher.get_portia()
+
+        lost = Deferred()
+
+        def disconnected(portia, reason):
+            dispatcher.portia_disconnected(portia, reason)
+            lost.callback(None)
+
+        portia.disconnected_callback = disconnected
+        portia.transport.loseConnection()
+        yield lost
+        self.assertFalse(dispatcher.is_ready())
+
+        msg = yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr='+27123456789')
+        self.assert_dispatched_endpoint(
+            msg, 'default', self.ch('transport2').get_dispatched_outbound())
+
+        self.clock.advance(dispatcher.initial_reconnect_delay)
+        yield endpoint.accept()
+        self.assertTrue(dispatcher.is_ready())
+
+    @inlineCallbacks
+    def test_outbound_prefix_fallback(self):
+        endpoint = self.get_pending_endpoint()
+        yield self.get_dispatcher(
+            portia_endpoint=endpoint,
+            prefix_fallback={'27': 'mno1', '27123': 'mno2'})
+        msg = yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr='+27123456789')
+        self.assert_dispatched_endpoint(
+            msg, 'default', self.ch('transport2').get_dispatched_outbound())
+
+    @inlineCallbacks
+    def test_portia_buffer_full(self):
+        endpoint = self.get_pending_endpoint()
+        yield self.get_dispatcher(
+            portia_endpoint=endpoint, portia_buffer_size=0)
+
+        msg = yield self.ch("transport1").make_dispatch_inbound(
+            "inbound", from_addr='+27123456789')
+        self.assert_dispatched_endpoint(
+            msg, 'default', self.ch('app1').get_dispatched_inbound())
+
+        yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr='+27123456789')
+        [failure] = self.flushLoggedErrors()
+        self.assertTrue(
+            "Not connected to Portia" in failure.getErrorMessage())
+
+    @inlineCallbacks
+    def test_resolve_cache(self):
+        to_addr = '+27123456789'
+        yield self.portia.annotate(
+            portia_normalize_msisdn(to_addr),
+            key='observed-network', value='mno1',
+            timestamp=self.portia.now())
+        dispatcher = yield self.get_dispatcher(resolve_cache_size=10)
+        yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr=to_addr)
+        self.assertEqual(dispatcher.health()['cached'], 1)
+
+        yield self.portia.annotate(
+            portia_normalize_msisdn(to_addr),
+            key='observed-network', value='mno2',
+            timestamp=self.portia.now())
+        yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr=to_addr)
+        self.assertEqual(
+            len(self.ch('transport1').get_dispatched_outbound()), 2)
+
+    @inlineCallbacks
+    def test_health_endpoint(self):
+        dispatcher = yield self.get_dispatcher(health_endpoint='tcp:0')
+        self.assertTrue(dispatcher.health_listener.getHost().port)
+
+    def test_mno_limits_unknown_mno(self):
+        failure = self.assertRaises(
+            DispatcherError, self.get_dispatcher,
+            mno_limits={'mno3': {'rate': 10}})
+        self.assertEqual(
+            str(failure), 'Limits configured for unknown MNO: mno3.')
+
+    def test_mno_limits_invalid(self):
+        failure = self.assertRaises(
+            DispatcherError, self.get_dispatcher,
+            mno_limits={'mno1': {'rate': 0}})
+        self.assertEqual(
+            str(failure), 'Limit rate for mno1 must be a positive number.')
+        failure = self.assertRaises(
+            DispatcherError, self.get_dispatcher,
+            mno_limits={'mno1': {'speed': 10}})
+        self.assertEqual(str(failure), 'Unknown limit for mno1: speed.')
+
+    @inlineCallbacks
+    def test_outbound_mno_limits(self):
+        for msisdn, mno in [('27123456781', 'mno1'),
+                            ('27123456782', 'mno1'),
+                            ('27123456783', 'mno2')]:
+            yield self.portia.annotate(
+                msisdn, key='observed-network', value=mno,
+                timestamp=self.portia.now())
+        dispatcher = yield self.get_dispatcher(
+            mno_limits={'mno1': {'rate': 1}})
+
+        yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr='+27123456781')
+        yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr='+27123456782')
+        yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr='+27123456783')
+        self.assertEqual(
+            len(self.ch('transport1').get_dispatched_outbound()), 1)
+        self.assertEqual(
+            len(self.ch('transport2').get_dispatched_outbound()), 1)
+        self.assertEqual(dispatcher.health()['buffered'], {'mno1': 1})
+
+        self.clock.advance(1)
+        self.assertEqual(
+            len(self.ch('transport1').get_dispatched_outbound()), 2)
+        self.assertEqual(dispatcher.health()['buffered'], {'mno1': 0})
+
+    @inlineCallbacks
+    def test_outbound_mno_limits_publish_failed(self):
+        yield self.portia.annotate(
+            '27123456781', key='observed-network', value='mno1',
+            timestamp=self.portia.now())
+        dispatcher = yield self.get_dispatcher(
+            mno_limits={'mno1': {'rate': 1}})
+        errbacks = []
+        self.patch(dispatcher, 'publish_outbound',
+                   lambda *args: fail(DispatcherError('Publish failed.')))
+        self.patch(dispatcher, 'errback_outbound',
+                   lambda f, msg, connector_name: errbacks.append(
+                       (msg, connector_name)) or f)
+
+        msg = yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr='+27123456781')
+        self.assertEqual(errbacks, [(msg, 'app1')])
+        [failure] = self.flushLoggedErrors(DispatcherError)
+        self.assertEqual(failure.getErrorMessage(), 'Publish failed.')
+
+    @inlineCallbacks
+    def test_teardown_flushes_mno_limits(self):
+        for msisdn in ['27123456781', '27123456782']:
+            yield self.portia.annotate(
+                msisdn, key='observed-network', value='mno1',
+                timestamp=self.portia.now())
+        dispatcher = yield self.get_dispatcher(
+            mno_limits={'mno1': {'rate': 1}})
+        yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr='+27123456781')
+        yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr='+27123456782')
+        self.assertEqual(dispatcher.health()['buffered'], {'mno1': 1})
+
+        yield dispatcher.teardown_dispatcher()
+        self.assertEqual(dispatcher.health()['buffered'], {'mno1': 0})
+        self.assertEqual(
+            len(self.ch('transport1').get_dispatched_outbound()), 2)
+
+    @inlineCallbacks
+    def test_reload_routing(self):
+        dispatcher = yield self.get_dispatcher(resolve_cache_size=10)
+        dispatcher.resolve_cache.set('27123456781', 'mno1')
+        dispatcher.resolve_cache.set('27123456782', 'mno2')
+        changed_mnos = yield dispatcher.reload_routing({
+            'transport1': {'default': 'mno1'},
+            'transport2': {'default': 'mno3'},
+        }, ['transport1', 'transport2'])
+        self.assertEqual(changed_mnos, set(['mno2', 'mno3']))
+        self.assertEqual(
+            dispatcher.resolve_cache.entries.keys(), ['27123456781'])
+
+        yield self.portia.annotate(
+            '27123456783', key='observed-network', value='mno3',
+            timestamp=self.portia.now())
+        msg = yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr='+27123456783')
+        self.assert_dispatched_endpoint(
+            msg, 'default', self.ch('transport2').get_dispatched_outbound())
+
+    @inlineCallbacks
+    def test_reload_routing_new_transport(self):
+        dispatcher = yield self.get_dispatcher()
+        yield dispatcher.get_portia()
+        yield dispatcher.reload_routing({
+            'transport1': {'default': 'mno1'},
+            'transport2': {'default': 'mno2'},
+            'transport3': {'default': 'mno3'},
+        }, ['transport1', 'transport2', 'transport3'])
+
+        msg = yield self.ch("transport3").make_dispatch_inbound(
+            "inbound", from_addr='+27123456789')
+        self.assert_dispatched_endpoint(
+            msg, 'default', self.ch('app1').get_dispatched_inbound())
+        resolve_response = yield self.portia.resolve('27123456789')
+        self.assertEqual(resolve_response['network'], 'mno3')
+
+        msg = yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr='+27123456789')
+        self.assert_dispatched_endpoint(
+            msg, 'default', self.ch('transport3').get_dispatched_outbound())
+
+    @inlineCallbacks
+    def test_reload_routing_removed_transport(self):
+        dispatcher = yield self.get_dispatcher()
+        yield dispatcher.reload_routing({
+            'transport1': {'default': 'mno1'},
+        }, ['transport1'])
+        consumers = dispatcher.connectors['transport2']._consumers
+        self.assertTrue(consumers['inbound'].paused)
+        self.assertFalse(consumers['event'].paused)
+        self.assertFalse(dispatcher.connectors['transport1'].paused)
+
+        msg = yield self.ch('transport2').make_dispatch_ack()
+        self.assert_dispatched_endpoint(
+            msg, 'default', self.ch('app1').get_dispatched_events())
+
+        yield dispatcher.reload_routing({
+            'transport1': {'default': 'mno1'},
+            'transport2': {'default': 'mno2'},
+        }, ['transport1', 'transport2'])
+        self.assertFalse(dispatcher.connectors['transport2'].paused)
+
+    @inlineCallbacks
+    def test_reload_routing_mno_limits(self):
+        dispatcher = yield self.get_dispatcher(
+            mno_limits={'mno1': {'rate': 1}, 'mno2': {'rate': 1}})
+        throttle = dispatcher.throttles['mno1']
+
+        failure = yield self.assertFailure(dispatcher.reload_routing({
+            'transport1': {'default': 'mno1'},
+            'transport2': {'default': 'mno3'},
+        }, ['transport1', 'transport2']), DispatcherError)
+        self.assertEqual(
+            str(failure), 'Limits configured for unknown MNO: mno2.')
+
+        yield dispatcher.reload_routing({
+            'transport1': {'default': 'mno1'},
+            'transport2': {'default': 'mno3'},
+        }, ['transport1', 'transport2'], {'mno1': {'rate': 2}})
+        self.assertEqual(dispatcher.throttles.keys(), ['mno1'])
+        self.assertIdentical(dispatcher.throttles['mno1'], throttle)
+        self.assertEqual(throttle.rate, 2)
+        self.assertEqual(dispatcher.health()['buffered'], {'mno1': 0})
+
+    @inlineCallbacks
+    def test_reload_routing_invalid(self):
+        dispatcher = yield self.get_dispatcher()
+        routing = dispatcher.routing
+        yield self.assertFailure(dispatcher.reload_routing({
+            'transport1': {'default': 'mno1'},
+            'transport2': {'default': 'mno1'},
+        }, ['transport1', 'transport2']), DispatcherError)
+        self.assertIdentical(dispatcher.routing, routing)
+
+    @inlineCallbacks
+    def test_reload_from_file(self):
+        path = self.mktemp()
+        with open(path, 'w') as fp:
+            yaml.safe_dump({
+                'mapping': {
+                    'transport1': {'default': 'mno3'},
+                    'transport2': {'default': 'mno2'},
+                },
+            }, fp)
+        dispatcher = yield self.get_dispatcher(mapping_reload_path=path)
+        yield dispatcher.reload_from_file()
+        self.assertEqual(
+            dispatcher.routing.mno_for('transport1', 'default'), 'mno3')
+
+    @inlineCallbacks
+    def test_reload_from_file_not_a_mapping(self):
+        path = self.mktemp()
+        with open(path, 'w') as fp:
+            yaml.safe_dump(['mapping'], fp)
+        dispatcher = yield self.get_dispatcher(mapping_reload_path=path)
+        routing = dispatcher.routing
+        yield dispatcher.reload_from_file()
+        self.assertIdentical(dispatcher.routing, routing)
+        [failure] = self.flushLoggedErrors()
+
+    @inlineCallbacks
+    def test_redis_cache(self):
+        @inlineCallbacks
+        def flush():
+            keys = yield self.redis.keys('test:resolve:*')
+            if keys:
+                yield self.redis.delete(*keys)
+        self.addCleanup(flush)
+
+        to_addr = '+27123456789'
+        yield self.portia.annotate(
+            portia_normalize_msisdn(to_addr),
+            key='observed-network', value='mno1',
+            timestamp=self.portia.now())
+        dispatcher = yield self.get_dispatcher(
+            redis_cache_uri='redis://localhost:6379/1',
+            redis_cache_prefix='test:resolve:')
+        yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr=to_addr)
+        yield dispatcher.redis_cache.last_set
+        network = yield self.redis.get('test:resolve:27123456789')
+        self.assertEqual(network, 'mno1')
+        ttl = yield self.redis.ttl('test:resolve:27123456789')
+        self.assertTrue(0 < ttl <= 3600)
+
+        # NOTE: Portia now knows better but the shared cache still has
+        #       the earlier resolve.
+        yield self.portia.annotate(
+            portia_normalize_msisdn(to_addr),
+            key='observed-network', value='mno2',
+            timestamp=self.portia.now())
+        network = yield dispatcher.resolve_network('27123456789')
+        self.assertEqual(network, 'mno1')
+
+    @inlineCallbacks
+    def test_portia_recording(self):
+        path = self.mktemp()
+        yield self.portia.annotate(
+            '27123456789', key='observed-network', value='mno1',
+            timestamp=self.portia.now())
+        dispatcher = yield self.get_dispatcher(portia_record_path=path)
+        msg = yield self.ch('app1').make_dispatch_outbound(
+            "outbound", to_addr='+27123456789')
+        self.assert_dispatched_endpoint(
+            msg, 'default', self.ch('transport1').get_dispatched_outbound())
+        dispatcher.recorder.fp.flush()
+        with open(path) as fp:
+            [(_, request, _, reply)] = read_recording(fp)
+        self.assertEqual(request['cmd'], 'resolve')
+        self.assertEqual(request['request'], {'msisdn': '27123456789'})
+        self.assertEqual(reply['reference_id'], request['id'])
+        self.assertEqual(reply['response']['network'], 'mno1')
@@ -0,0 +1,44 @@
+import json
+
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from vxportia.health import HealthResource
+
+
+class FakeDispatcher(object):
+
+    ready = False
+
+    def health(self):
+        return {'ready': self.ready}
+
+
+class TestHealthResource(TestCase):
+
+    def setUp(self):
+        self.dispatcher = FakeDispatcher()
+        self.resource = HealthResource(self.dispatcher)
+
+    def render(self, path):
+        request = DummyRequest(path.strip('/').split('/'))
+        request.path = path
+        body = self.resource.render_GET(request)
+        return request.responseCode or 200, body
+
+    def test_health(self):
+        code, body = self.render('/health')
+        self.assertEqual(code, 200)
+        self.assertEqual(json.loads(body), {'ready': False})
+
+    def test_ready(self):
+        code, body = self.render('/ready')
+        self.assertEqual(code, 503)
+        self.dispatcher.ready = True
+        code, body = self.render('/ready')
+        self.assertEqual(code, 200)
+        self.assertEqual(json.loads(body), {'ready': True})
+
+    def test_not_found(self):
+        code, body = self.render('/foo')
+        self.assertEqual(code, 404)
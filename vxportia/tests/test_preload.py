@@ -0,0 +1,237 @@
+import pkg_resources
+from StringIO import StringIO
+
+from portia.portia import Portia
+from portia.utils import (
+    start_redis, start_tcpserver, compile_network_prefix_mappings)
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.endpoints import clientFromString
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from vxportia.preload import (
+    PortiaPool, Preloader, connect_pool, read_rows)
+from vxportia.protocol import PortiaProtocol, PortiaProtocolException
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.pending = []
+
+    def annotate(self, msisdn, key, value, timestamp=None):
+        d = Deferred()
+        self.pending.append((msisdn, d))
+        return d
+
+
+class TestReadRows(TestCase):
+
+    def test_read_rows(self):
+        fp = StringIO(
+            'msisdn,network\n27123456789,MTN\n27123456780,VODACOM\n')
+        self.assertEqual(list(read_rows(fp)), [
+            (1, '27123456789', 'MTN'),
+            (2, '27123456780', 'VODACOM'),
+        ])
+
+    def test_read_rows_skip(self):
+        fp = StringIO('27123456789,MTN\n27123456780,VODACOM\n')
+        self.assertEqual(list(read_rows(fp, has_header=False, skip=1)), [
+            (2, '27123456780', 'VODACOM'),
+        ])
+
+    def test_read_rows_malformed(self):
+        fp = StringIO('27123456789\n\n27123456780,VODACOM\n')
+        self.assertEqual(list(read_rows(fp, has_header=False)), [
+            (3, '27123456780', 'VODACOM'),
+        ])
+
+
+class TestPortiaPool(TestCase):
+
+    def test_pick_skips_closed(self):
+        protocols = [PortiaProtocol(), PortiaProtocol()]
+        for protocol in protocols:
+            protocol.makeConnection(StringTransport())
+        pool = PortiaPool(list(protocols))
+        protocols[0].queue['foo'] = Deferred().addErrback(lambda _: None)
+        self.assertEqual(pool.pick(), protocols[1])
+
+        protocols[1].connectionLost(None)
+        self.assertEqual(pool.pick(), protocols[0])
+        self.assertEqual(pool.protocols, [protocols[0]])
+
+        protocols[0].connectionLost(None)
+        self.assertRaises(PortiaProtocolException, pool.pick)
+
+
+class TestPreloader(TestCase):
+
+    timeout = 1
+
+    @inlineCallbacks
+    def setUp(self):
+        self.redis = yield start_redis()
+        self.addCleanup(self.redis.disconnect)
+
+        self.portia = Portia(
+            self.redis,
+            network_prefix_mapping=compile_network_prefix_mappings(
+                [pkg_resources.resource_filename(
+                    'portia', 'assets/mappings/*.mapping.json')]))
+        self.addCleanup(self.portia.flush)
+
+        self.listener = yield start_tcpserver(self.portia, 'tcp:0')
+        self.addCleanup(self.listener.loseConnection)
+
+    @inlineCallbacks
+    def get_pool(self, size=2):
+        address = self.listener.getHost()
+        pool = yield connect_pool(
+            clientFromString(
+                reactor, 'tcp:%s:%s' % (address.host, address.port)),
+            size)
+        self.addCleanup(pool.disconnect)
+        returnValue(pool)
+
+    def get_preloader(self, pool, **kwargs):
+        preloader = Preloader(pool, **kwargs)
+        preloader.clock = Clock()
+        return preloader
+
+    @inlineCallbacks
+    def test_preload(self):
+        pool = yield self.get_pool()
+        preloader = self.get_preloader(pool)
+        fp = StringIO(
+            'msisdn,network\n+27123456789,MTN\n+27123456780,CELLC\n')
+        result = yield preloader.run(read_rows(fp))
+        self.assertEqual(result, (2, 0))
+
+        response = yield self.portia.resolve('27123456789')
+        self.assertEqual(response['network'], 'MTN')
+        self.assertEqual(response['strategy'], 'observed-network')
+        response = yield self.portia.resolve('27123456780')
+        self.assertEqual(response['network'], 'CELLC')
+
+    @inlineCallbacks
+    def test_preload_key(self):
+        pool = yield self.get_pool()
+        preloader = self.get_preloader(pool, key='ported-to')
+        fp = StringIO('27123456789,MTN\n')
+        yield preloader.run(read_rows(fp, has_header=False))
+        response = yield self.portia.resolve('27123456789')
+        self.assertEqual(response['network'], 'MTN')
+        self.assertEqual(response['strategy'], 'ported-to')
+
+    @inlineCallbacks
+    def test_preload_failure(self):
+        pool = yield self.get_pool()
+        preloader = self.get_preloader(pool, key='invalid-key')
+        fp = StringIO('27123456789,MTN\n')
+        result = yield preloader.run(read_rows(fp, has_header=False))
+        self.assertEqual(result, (0, 1))
+        [failure] = self.flushLoggedErrors()
+        self.assertEqual(
+            failure.value.message, 'Invalid Key: invalid-key')
+
+    @inlineCallbacks
+    def test_resume_from_checkpoint(self):
+        checkpoint_path = self.mktemp()
+        with open(checkpoint_path, 'w') as fp:
+            fp.write('1\n')
+
+        pool = yield self.get_pool()
+        preloader = self.get_preloader(
+            pool, checkpoint_path=checkpoint_path)
+        fp = StringIO('27123456789,MTN\n27123456780,CELLC\n')
+        skip = preloader.read_checkpoint()
+        result = yield preloader.run(
+            read_rows(fp, has_header=False, skip=skip), skip=skip)
+        self.assertEqual(result, (1, 0))
+
+        response = yield self.portia.resolve('27123456789')
+        self.assertEqual(response['strategy'], 'prefix-guess')
+        response = yield self.portia.resolve('27123456780')
+        self.assertEqual(response['network'], 'CELLC')
+        self.assertEqual(preloader.read_checkpoint(), 2)
+
+    @inlineCallbacks
+    def test_resume_completed(self):
+        checkpoint_path = self.mktemp()
+        with open(checkpoint_path, 'w') as fp:
+            fp.write('2\n')
+
+        preloader = self.get_preloader(
+            FakePool(), checkpoint_path=checkpoint_path)
+        fp = StringIO('27123456789,MTN\n27123456780,CELLC\n')
+        skip = preloader.read_checkpoint()
+        result = yield preloader.run(
+            read_rows(fp, has_header=False, skip=skip), skip=skip)
+        self.assertEqual(result, (0, 0))
+        self.assertEqual(preloader.read_checkpoint(), 2)
+
+    def test_checkpoint_before_failed_row(self):
+        pool = FakePool()
+        preloader = self.get_preloader(
+            pool, window=2, checkpoint_path=self.mktemp())
+        fp = StringIO('27123456781,MTN\n27123456782,MTN\n')
+        d = preloader.run(read_rows(fp, has_header=False))
+
+        def check(_):
+            pool.pending[0][1].callback('ok')
+            pool.pending[1][1].errback(PortiaProtocolException('Failed.'))
+            self.assertEqual(len(self.flushLoggedErrors()), 1)
+            # A resumed run retries the failed row.
+            self.assertEqual(preloader.checkpoint(), 1)
+            return d
+
+        settle = Deferred()
+        settle.addCallback(check)
+        settle.addCallback(self.assertEqual, (1, 1))
+        settle.addCallback(lambda _: self.assertEqual(
+            preloader.read_checkpoint(), 1))
+        reactor.callLater(0.05, settle.callback, None)
+        return settle
+
+    def test_window(self):
+        pool = FakePool()
+        preloader = self.get_preloader(
+            pool, window=2, checkpoint_path=self.mktemp())
+        fp = StringIO('27123456781,MTN\n27123456782,MTN\n27123456783,MTN\n')
+        d = preloader.run(read_rows(fp, has_header=False))
+
+        def check_window(_):
+            self.assertEqual(len(pool.pending), 2)
+            self.assertEqual(preloader.checkpoint(), 0)
+            # Completing the second row doesn't move the checkpoint past
+            # the first row which is still in flight.
+            pool.pending[1][1].callback('ok')
+            self.assertEqual(preloader.checkpoint(), 0)
+            pool.pending[0][1].callback('ok')
+            self.assertEqual(preloader.checkpoint(), 2)
+
+        def check_done(_):
+            self.assertEqual(len(pool.pending), 3)
+            self.assertFalse(d.called)
+            pool.pending[2][1].callback('ok')
+            self.assertEqual(preloader.read_checkpoint(), 3)
+
+        settle = Deferred()
+        settle.addCallback(check_window)
+        settle.addCallback(lambda _: wait())
+        settle.addCallback(check_done)
+        settle.addCallback(lambda _: d)
+        settle.addCallback(self.assertEqual, (3, 0))
+
+        def wait():
+            waiter = Deferred()
+            reactor.callLater(0.05, waiter.callback, None)
+            return waiter
+
+        reactor.callLater(0.05, settle.callback, None)
+        return settle
@@ -0,0 +1,88 @@
+import os
+import signal
+import sys
+
+from twisted.internet.defer import succeed, fail
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxportia.profiling import DispatcherProfiler, timed_handler
+
+
+class Handler(object):
+
+    profiler = None
+
+    @timed_handler
+    def process_inbound(self, result):
+        return result
+
+
+class TestDispatcherProfiler(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.profiler = DispatcherProfiler(
+            lag_interval=1, report_interval=10, sample_duration=5,
+            dump_path=self.mktemp() + '-%(pid)s.txt')
+        self.profiler.clock = self.clock
+        self.addCleanup(self.profiler.stop)
+
+    def test_reactor_lag(self):
+        self.profiler.start()
+        self.clock.advance(1)
+        self.clock.advance(3)
+        self.assertEqual(self.profiler.lag_stats.count, 2)
+        self.assertEqual(self.profiler.lag_stats.max, 2)
+        self.assertEqual(self.profiler.lag_stats.mean(), 1)
+
+    def test_report_resets_stats(self):
+        self.profiler.start()
+        self.profiler.time_call('process_inbound', lambda: succeed(None))
+        self.clock.advance(10)
+        self.assertEqual(self.profiler.handler_stats, {})
+        self.assertEqual(self.profiler.lag_stats.count, 0)
+
+    def test_timed_handler(self):
+        handler = Handler()
+        self.assertEqual(handler.process_inbound('foo'), 'foo')
+
+        handler.profiler = self.profiler
+        d = handler.process_inbound(succeed('foo'))
+        self.assertEqual(self.successResultOf(d), 'foo')
+        d = handler.process_inbound(fail(ValueError('bar')))
+        self.failureResultOf(d, ValueError)
+
+        stats = self.profiler.handler_stats['process_inbound']
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.errors, 1)
+
+    def test_sampling(self):
+        siginterrupts = []
+        self.patch(signal, 'siginterrupt', lambda signum, flag: (
+            siginterrupts.append((signum, flag))))
+        self.profiler.start_sampling()
+        self.assertEqual(
+            signal.getsignal(signal.SIGPROF), self.profiler.sample)
+        self.assertEqual(siginterrupts, [(signal.SIGPROF, False)])
+        self.profiler.sample(signal.SIGPROF, sys._getframe())
+        self.clock.advance(5)
+
+        self.assertEqual(self.profiler.sampling_call, None)
+        self.assertEqual(signal.getsignal(signal.SIGPROF), signal.SIG_DFL)
+        self.assertEqual(siginterrupts, [
+            (signal.SIGPROF, False), (signal.SIGPROF, True)])
+        path = self.profiler.dump_path % {'pid': os.getpid()}
+        with open(path) as fp:
+            [line] = fp.readlines()
+        stack, count = line.rsplit(' ', 1)
+        self.assertTrue(stack.endswith(':test_sampling'))
+        self.assertEqual(count, '1\n')
+
+    def test_signal_handler(self):
+        previous = signal.getsignal(signal.SIGUSR2)
+        self.profiler.install_signal_handler('SIGUSR2')
+        self.assertEqual(
+            signal.getsignal(signal.SIGUSR2), self.profiler.handle_signal)
+        self.profiler.stop()
+        self.assertEqual(signal.getsignal(signal.SIGUSR2), previous)
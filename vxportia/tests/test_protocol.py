@@ -35,6 +35,7 @@ class TestPortiaProtocol(TestCase):
         self.proto = factory.buildProtocol(None)
         self.proto.clock = Clock()
         self.transport = StringTransportWithDisconnection()
+        self.transport.protocol = self.proto
         self.proto.makeConnection(self.transport)
 
     def read_command(self):
@@ -139,3 +140,106 @@ class TestPortiaProtocol(TestCase):
         self.reply(command, "ok")
         response = yield d
         self.assertEqual(response, 'ok')
+
+    def read_sent(self):
+        commands = [json.loads(line)
+                    for line in self.transport.value().splitlines()]
+        self.transport.clear()
+        return commands
+
+    def assert_sent(self, *expected):
+        self.assertEqual(
+            [(command['cmd'], command['request']['msisdn'])
+             for command in self.read_sent()],
+            list(expected))
+
+    def test_unlimited_in_flight(self):
+        self.proto.annotate('1', key='X-Key', value='value')
+        self.proto.resolve('2')
+        self.assert_sent(('annotate', '1'), ('resolve', '2'))
+
+    def test_priority(self):
+        self.proto.max_in_flight = 1
+        self.proto.annotate('1', key='X-Key', value='value')
+        [command] = self.read_sent()
+        self.proto.annotate('2', key='X-Key', value='value')
+        self.proto.get('3')
+        self.proto.resolve('4')
+        self.assert_sent()
+
+        self.reply(command, 'ok')
+        [command] = self.read_sent()
+        self.assertEqual(command['cmd'], 'get')
+        self.reply(command, {})
+        [command] = self.read_sent()
+        self.assertEqual(command['cmd'], 'resolve')
+        self.reply(command, {'network': None})
+        self.assert_sent(('annotate', '2'))
+
+    def test_starvation_limit(self):
+        self.proto.max_in_flight = 1
+        self.proto.starvation_limit = 2
+        self.proto.annotate('1', key='X-Key', value='value')
+        self.proto.annotate('2', key='X-Key', value='value')
+        for msisdn in ['3', '4', '5']:
+            self.proto.resolve(msisdn)
+
+        sent = []
+        while self.proto.in_flight:
+            [command] = self.read_sent()
+            sent.append(command['request']['msisdn'])
+            self.reply(command, {})
+        self.assertEqual(sent, ['1', '3', '4', '2', '5'])
+
+    @inlineCallbacks
+    def test_connection_lost(self):
+        self.proto.max_in_flight = 1
+        d1 = self.proto.annotate('1', key='X-Key', value='value')
+        d2 = self.proto.annotate('2', key='X-Key', value='value')
+        self.transport.loseConnection()
+        f = yield self.assertFailure(d1, PortiaProtocolException)
+        self.assertEqual(f.message, 'Connection lost.')
+        yield self.assertFailure(d2, PortiaProtocolException)
+        self.assertFalse(self.proto.connected)
+        self.assertEqual(self.proto.queue, {})
+        self.assertEqual(self.proto.in_flight, set())
+        self.assertFalse(any(self.proto.send_queues))
+
+    @inlineCallbacks
+    def test_timeout_starts_when_sent(self):
+        self.proto.max_in_flight = 1
+        self.proto.annotate('1', key='X-Key', value='value')
+        [command] = self.read_sent()
+        d = self.proto.annotate('2', key='X-Key', value='value')
+        self.proto.clock.advance(self.proto.timeout - 1)
+        self.reply(command, 'ok')
+        self.assert_sent(('annotate', '2'))
+        self.proto.clock.advance(self.proto.timeout - 1)
+        self.assertFalse(d.called)
+        self.proto.clock.advance(1)
+        f = yield self.assertFailure(d, PortiaProtocolException)
+        self.assertEqual(f.message, 'Timeout exceeded.')
+        self.assertEqual(self.proto.timeouts, {})
+
+    @inlineCallbacks
+    def test_max_queued(self):
+        self.proto.max_in_flight = 1
+        self.proto.max_queued = 1
+        self.proto.annotate('1', key='X-Key', value='value')
+        [command] = self.read_sent()
+        self.proto.annotate('2', key='X-Key', value='value')
+        f = yield self.assertFailure(
+            self.proto.annotate('3', key='X-Key', value='value'),
+            PortiaProtocolException)
+        self.assertEqual(f.message, 'Send queue full.')
+
+        # Resolves have their own limit and still get through.
+        d = self.proto.resolve('4')
+        yield self.assertFailure(
+            self.proto.resolve('5'), PortiaProtocolException)
+        self.reply(command, 'ok')
+        [command] = self.read_sent()
+        self.assertEqual(command['request']['msisdn'], '4')
+        self.reply(command, {'network': 'MTN'})
+        response = yield d
+        self.assertEqual(response['network'], 'MTN')
@@ -0,0 +1,97 @@
+import json
+from StringIO import StringIO
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxportia.recording import (
+    TrafficRecorder, open_recording, read_recording)
+
+
+class TestTrafficRecorder(TestCase):
+
+    def get_recorder(self, fp, **kwargs):
+        recorder = TrafficRecorder(fp, **kwargs)
+        recorder.clock = Clock()
+        return recorder
+
+    def test_record(self):
+        fp = StringIO()
+        recorder = self.get_recorder(fp)
+        recorder.request('ref1', '{"cmd": "get"}')
+        recorder.clock.advance(0.5)
+        recorder.reply('ref1', '{"status": "ok"}')
+        self.assertEqual(fp.getvalue(), (
+            '0.000000 > ref1 {"cmd": "get"}\n'
+            '0.500000 < ref1 {"status": "ok"}\n'))
+
+    def test_sample_rate(self):
+        fp = StringIO()
+        recorder = self.get_recorder(fp, sample_rate=0.5)
+        reference_ids = ['ref%s' % (i,) for i in range(200)]
+        sampled = [reference_id for reference_id in reference_ids
+                   if recorder.sampled(reference_id)]
+        self.assertTrue(50 < len(sampled) < 150)
+
+        for reference_id in reference_ids:
+            recorder.request(reference_id, '{}')
+            recorder.reply(reference_id, '{}')
+        self.assertEqual(
+            len(fp.getvalue().splitlines()), len(sampled) * 2)
+
+        recorder = self.get_recorder(StringIO(), sample_rate=0)
+        self.assertFalse(any(map(recorder.sampled, reference_ids)))
+
+    def test_read_recording(self):
+        fp = StringIO(
+            '1.0 > ref1 {"cmd": "get"}\n'
+            '1.5 > ref2 {"cmd": "resolve"}\n'
+            '1.6 > ref3 {"cmd": "resolve"}\n'
+            '2.0 < ref2 {"status": "error"}\n'
+            '2.5 < ref1 {"status": "ok"}\n')
+        self.assertEqual(read_recording(fp), [
+            (1.0, {'cmd': 'get'}, 1.5, {'status': 'ok'}),
+            (1.5, {'cmd': 'resolve'}, 0.5, {'status': 'error'}),
+        ])
+
+    def test_gzip(self):
+        path = self.mktemp() + '.gz'
+        recorder = self.get_recorder(open_recording(path, 'w'))
+        recorder.request('ref1', json.dumps({'cmd': 'get'}))
+        recorder.reply('ref1', json.dumps({'status': 'ok'}))
+        recorder.close()
+        with open_recording(path) as fp:
+            self.assertEqual(read_recording(fp), [
+                (0.0, {'cmd': 'get'}, 0.0, {'status': 'ok'}),
+            ])
+
+    def test_read_recording_truncated(self):
+        fp = StringIO(
+            '1.0 > ref1 {"cmd": "get"}\n'
+            '2.0 < ref1 {"status": "ok"}\n'
+            '2.5 > ref2 {"cmd": "ge')
+        self.assertEqual(read_recording(fp), [
+            (1.0, {'cmd': 'get'}, 1.0, {'status': 'ok'}),
+        ])
+
+    def test_gzip_not_closed(self):
+        path = self.mktemp() + '.gz'
+        recorder = self.get_recorder(open_recording(path, 'w'))
+        self.addCleanup(recorder.close)
+        recorder.request('ref1', json.dumps({'cmd': 'get'}))
+        recorder.clock.advance(recorder.flush_interval)
+        recorder.reply('ref1', json.dumps({'status': 'ok'}))
+        with open_recording(path) as fp:
+            self.assertEqual(read_recording(fp), [
+                (0.0, {'cmd': 'get'}, 5.0, {'status': 'ok'}),
+            ])
+
+    def test_gzip_appended(self):
+        path = self.mktemp() + '.gz'
+        for reference_id in ['ref1', 'ref2']:
+            recorder = self.get_recorder(open_recording(path, 'a'))
+            recorder.request(reference_id, json.dumps({'cmd': 'get'}))
+            recorder.reply(reference_id, json.dumps({'status': 'ok'}))
+            recorder.close()
+        with open_recording(path) as fp:
+            self.assertEqual(len(read_recording(fp)), 2)
@@ -0,0 +1,127 @@
+import json
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.endpoints import clientFromString, serverFromString
+from twisted.internet.protocol import Factory
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from vxportia.protocol import PortiaProtocol
+from vxportia.replay import ReplayDriver, ReplayPortiaFactory
+
+
+def exchange(sent, cmd, request, delay, response):
+    return (sent, {
+        'cmd': cmd,
+        'id': 'recorded-%s' % (sent,),
+        'version': PortiaProtocol.version,
+        'request': request,
+    }, delay, {
+        'status': 'ok',
+        'cmd': 'reply',
+        'reference_cmd': cmd,
+        'reference_id': 'recorded-%s' % (sent,),
+        'version': PortiaProtocol.version,
+        'response': response,
+    })
+
+
+EXCHANGES = [
+    exchange(1.0, 'resolve', {'msisdn': '27123456781'}, 0.2,
+             {'network': 'MTN', 'strategy': 'observed-network'}),
+    exchange(1.01, 'get', {'msisdn': '27123456782'}, 0.1,
+             {'observed-network': 'CELLC'}),
+    exchange(1.02, 'resolve', {'msisdn': '27123456781'}, 0.3,
+             {'network': 'VODACOM', 'strategy': 'ported-to'}),
+]
+
+
+class TestReplayPortiaFactory(TestCase):
+
+    def get_protocol(self, speed=1.0):
+        factory = ReplayPortiaFactory(EXCHANGES, speed=speed)
+        factory.clock = Clock()
+        protocol = factory.buildProtocol(None)
+        self.transport = StringTransport()
+        protocol.makeConnection(self.transport)
+        return protocol
+
+    def send(self, protocol, cmd, reference_id, **request):
+        protocol.dataReceived('%s\r\n' % (json.dumps({
+            'cmd': cmd,
+            'id': reference_id,
+            'version': PortiaProtocol.version,
+            'request': request,
+        }),))
+
+    def read_replies(self):
+        replies = [json.loads(line)
+                   for line in self.transport.value().splitlines()]
+        self.transport.clear()
+        return replies
+
+    def test_recorded_delay(self):
+        protocol = self.get_protocol(speed=2.0)
+        self.send(protocol, 'resolve', 'ref1', msisdn='27123456781')
+        protocol.factory.clock.advance(0.09)
+        self.assertEqual(self.read_replies(), [])
+        protocol.factory.clock.advance(0.02)
+        [reply] = self.read_replies()
+        self.assertEqual(reply['reference_id'], 'ref1')
+        self.assertEqual(reply['response']['network'], 'MTN')
+
+    def test_cycles_replies(self):
+        protocol = self.get_protocol(speed=0)
+        for reference_id in ['ref1', 'ref2', 'ref3']:
+            self.send(
+                protocol, 'resolve', reference_id, msisdn='27123456781')
+        protocol.factory.clock.advance(0)
+        self.assertEqual(
+            [reply['response']['network'] for reply in self.read_replies()],
+            ['MTN', 'VODACOM', 'MTN'])
+
+    def test_unrecorded_request(self):
+        protocol = self.get_protocol()
+        self.send(protocol, 'resolve', 'ref1', msisdn='27000000000')
+        protocol.factory.clock.advance(0)
+        [reply] = self.read_replies()
+        self.assertEqual(reply['status'], 'error')
+        self.assertEqual(reply['reference_id'], 'ref1')
+        self.assertEqual(
+            reply['message'], 'No recorded reply for this request.')
+
+
+class TestReplayDriver(TestCase):
+
+    timeout = 1
+
+    @inlineCallbacks
+    def get_portia(self, speed):
+        port = yield serverFromString(reactor, 'tcp:0').listen(
+            ReplayPortiaFactory(EXCHANGES, speed=speed))
+        self.addCleanup(port.stopListening)
+        portia = yield clientFromString(
+            reactor, 'tcp:127.0.0.1:%s' % (port.getHost().port,)).connect(
+                Factory.forProtocol(PortiaProtocol))
+        self.addCleanup(portia.transport.loseConnection)
+        returnValue(portia)
+
+    @inlineCallbacks
+    def test_drive_flat_out(self):
+        portia = yield self.get_portia(speed=0)
+        driver = ReplayDriver(portia, EXCHANGES, speed=0)
+        stats = yield driver.run()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['errors'], 0)
+
+    @inlineCallbacks
+    def test_drive_paced(self):
+        portia = yield self.get_portia(speed=10)
+        driver = ReplayDriver(portia, EXCHANGES, speed=10)
+        stats = yield driver.run()
+        self.assertEqual(stats['requests'], 3)
+        # The last reply takes 0.03s to come back at 10x.
+        self.assertTrue(stats['elapsed'] >= 0.03)
+        self.assertTrue(stats['p99'] >= 0.02)
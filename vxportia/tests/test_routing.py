@@ -0,0 +1,56 @@
+from twisted.trial.unittest import TestCase
+
+from vumi.errors import DispatcherError
+
+from vxportia.routing import RoutingTable
+
+
+class TestRoutingTable(TestCase):
+
+    def compile(self, mapping):
+        return RoutingTable.compile(mapping, mapping.keys())
+
+    def test_compile(self):
+        routing = self.compile({
+            'transport1': {'default': 'mno1', 'ep1': 'mno2'},
+            'transport2': {'default': 'mno3'},
+        })
+        self.assertEqual(
+            routing.connectors, set(['transport1', 'transport2']))
+        self.assertEqual(
+            routing.mno_names, set(['mno1', 'mno2', 'mno3']))
+        self.assertEqual(routing.mno_for('transport1', 'ep1'), 'mno2')
+        self.assertEqual(routing.mno_for('transport2', 'ep1'), None)
+        self.assertEqual(
+            routing.target_for('mno3'), ('transport2', 'default'))
+        self.assertEqual(routing.target_for('mno4'), None)
+
+    def test_not_unique(self):
+        failure = self.assertRaises(
+            DispatcherError, self.compile, {
+                'transport1': {'default': 'mno1'},
+                'transport2': {'default': 'mno1'},
+            })
+        self.assertEqual(
+            str(failure), 'PortiaDispatcher mappings are not unique.')
+
+    def test_unmapped_connector(self):
+        failure = self.assertRaises(
+            DispatcherError, RoutingTable.compile, {
+                'transport1': {'default': 'mno1'},
+            }, ['transport1', 'transport2'])
+        self.assertEqual(
+            str(failure), 'Not all receive_inbound_connectors mapped to MNOs.')
+
+    def test_changed_mnos(self):
+        routing = self.compile({
+            'transport1': {'default': 'mno1', 'ep1': 'mno2'},
+            'transport2': {'default': 'mno3'},
+        })
+        reloaded = self.compile({
+            'transport1': {'default': 'mno1', 'ep1': 'mno3'},
+            'transport2': {'default': 'mno4'},
+        })
+        self.assertEqual(
+            reloaded.changed_mnos(routing), set(['mno2', 'mno3', 'mno4']))
+        self.assertEqual(routing.changed_mnos(routing), set())
@@ -0,0 +1,110 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxportia.throttle import MNOThrottle
+
+
+class TestMNOThrottle(TestCase):
+
+    def get_throttle(self, **kwargs):
+        throttle = MNOThrottle(**kwargs)
+        throttle.clock = Clock()
+        return throttle
+
+    def test_unlimited(self):
+        throttle = self.get_throttle()
+        calls = []
+        for i in range(5):
+            throttle.submit(calls.append, i)
+        self.assertEqual(calls, [0, 1, 2, 3, 4])
+
+    def test_rate(self):
+        throttle = self.get_throttle(rate=2, burst=2)
+        calls = []
+        for i in range(5):
+            throttle.submit(calls.append, i)
+        self.assertEqual(calls, [0, 1])
+        throttle.clock.advance(0.5)
+        self.assertEqual(calls, [0, 1, 2])
+        throttle.clock.advance(1)
+        self.assertEqual(calls, [0, 1, 2, 3, 4])
+        self.assertEqual(len(throttle), 0)
+
+    def test_concurrency(self):
+        throttle = self.get_throttle(concurrency=1)
+        pending = []
+
+        def call():
+            d = Deferred()
+            pending.append(d)
+            return d
+
+        throttle.submit(call)
+        throttle.submit(call)
+        self.assertEqual(len(pending), 1)
+        pending[0].callback(None)
+        self.assertEqual(len(pending), 2)
+        self.assertEqual(throttle.in_flight, 1)
+
+    def test_reconfigure(self):
+        throttle = self.get_throttle(rate=1)
+        calls = []
+        for i in range(3):
+            throttle.submit(calls.append, i)
+        self.assertEqual(calls, [0])
+        throttle.reconfigure(rate=2)
+        throttle.clock.advance(0.5)
+        self.assertEqual(calls, [0, 1])
+        throttle.reconfigure()
+        self.assertEqual(calls, [0, 1, 2])
+        self.assertEqual(throttle.drain_call, None)
+
+    def test_buffer_full(self):
+        throttle = self.get_throttle(rate=1, buffer_size=1)
+        calls = []
+        throttle.submit(calls.append, 0)
+        d1 = throttle.submit(calls.append, 1)
+        d2 = throttle.submit(calls.append, 2)
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called)
+        throttle.clock.advance(1)
+        self.assertEqual(calls, [0, 1])
+        self.assertTrue(d2.called)
+
+    def test_failed_call(self):
+        throttle = self.get_throttle(concurrency=1)
+        calls = []
+        throttle.submit(lambda: 1 / 0)
+        throttle.submit(calls.append, 1)
+        self.assertEqual(calls, [1])
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+    def test_flush(self):
+        throttle = self.get_throttle(rate=1, buffer_size=1)
+        calls = []
+        for i in range(3):
+            throttle.submit(calls.append, i)
+        d = throttle.flush()
+        self.assertEqual(calls, [0, 1, 2])
+        self.assertEqual(throttle.drain_call, None)
+        self.assertTrue(d.called)
+
+    def test_flush_waits(self):
+        throttle = self.get_throttle(rate=1)
+        pending = []
+
+        def call():
+            d = Deferred()
+            pending.append(d)
+            return d
+
+        for i in range(3):
+            throttle.submit(call)
+        self.assertEqual(len(pending), 1)
+        d = throttle.flush()
+        self.assertEqual(len(pending), 3)
+        pending[2].callback(None)
+        self.assertFalse(d.called)
+        pending[1].callback(None)
+        self.assertTrue(d.called)
@@ -0,0 +1,113 @@
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, gatherResults, maybeDeferred, succeed)
+from twisted.python import log
+
+
+class MNOThrottle(object):
+
+    clock = reactor
+
+    def __init__(self, rate=None, burst=None, concurrency=None,
+                 buffer_size=100):
+        self.configure(rate, burst, concurrency, buffer_size)
+        self.tokens = self.burst
+        self.last_refill = None
+        self.in_flight = 0
+        self.pending = deque()
+        self.room_waiters = deque()
+        self.drain_call = None
+
+    def configure(self, rate=None, burst=None, concurrency=None,
+                  buffer_size=100):
+        self.rate = rate
+        self.burst = burst or max(rate or 1, 1)
+        self.concurrency = concurrency
+        self.buffer_size = buffer_size
+
+    def reconfigure(self, **limits):
+        # Keeps whatever is buffered, it's sent under the new limits.
+        self.refill()
+        self.configure(**limits)
+        self.tokens = min(self.tokens, self.burst)
+        if self.drain_call is not None:
+            self.drain_call.cancel()
+            self.drain_call = None
+        self.drain()
+
+    def __len__(self):
+        return len(self.pending) + len(self.room_waiters)
+
+    def submit(self, func, *args):
+        # The returned Deferred fires once the call has been buffered,
+        # not once it has been made. It only waits if the buffer is full.
+        # Callers that ack on it lose whatever is buffered if the process
+        # dies, `buffer_size` bounds how much that can be.
+        if len(self.pending) < self.buffer_size:
+            self.pending.append((func, args))
+            self.drain()
+            return succeed(None)
+        d = Deferred()
+        self.room_waiters.append((d, func, args))
+        return d
+
+    def refill(self):
+        now = self.clock.seconds()
+        if self.rate and self.last_refill is not None:
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def can_run(self):
+        if self.concurrency and self.in_flight >= self.concurrency:
+            return False
+        return not self.rate or self.tokens >= 1
+
+    def run(self, func, args):
+        self.in_flight += 1
+        d = maybeDeferred(func, *args)
+        d.addErrback(log.err)
+        d.addBoth(self.done)
+        return d
+
+    def done(self, _):
+        self.in_flight -= 1
+        self.drain()
+
+    def drain(self):
+        self.refill()
+        while self.pending and self.can_run():
+            if self.rate:
+                self.tokens -= 1
+            self.run(*self.pending.popleft())
+
+        while self.room_waiters and len(self.pending) < self.buffer_size:
+            d, func, args = self.room_waiters.popleft()
+            self.pending.append((func, args))
+            d.callback(None)
+
+        if (self.pending and self.rate and self.tokens < 1 and
+                self.drain_call is None):
+            self.drain_call = self.clock.callLater(
+                (1 - self.tokens) / self.rate, self.scheduled_drain)
+
+    def scheduled_drain(self):
+        self.drain_call = None
+        self.drain()
+
+    def flush(self):
+        # Ignores the limits, used when shutting down so that nothing
+        # buffered is lost. The returned Deferred fires once all the
+        # flushed calls are done.
+        if self.drain_call is not None:
+            self.drain_call.cancel()
+            self.drain_call = None
+        while self.room_waiters:
+            d, func, args = self.room_waiters.popleft()
+            self.pending.append((func, args))
+            d.callback(None)
+        pending, self.pending = self.pending, deque()
+        return gatherResults([self.run(*call) for call in pending])